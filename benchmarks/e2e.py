@@ -0,0 +1,161 @@
+# End-to-end benchmark of full scrape cycles against the local fake server.
+# Usage: python -m benchmarks.e2e [--accounts 1 8] [--courses 10 1000 10000]
+import argparse
+import logging
+import statistics
+import tempfile
+import threading
+import time
+
+from njupt_score_pusher.app import (
+    AccountConfig,
+    GlobalConfig,
+    IncrementalConfig,
+    app_main,
+)
+from njupt_score_pusher.phases import add_phase_observer, remove_phase_observer
+from njupt_score_pusher.pusher.common import BatchConfig
+from benchmarks.fake_server import FakeServer
+
+
+class PhaseRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples: dict[str, list[float]] = {}
+
+    def __call__(self, name: str, elapsed: float, error: BaseException | None):
+        with self.lock:
+            self.samples.setdefault(name, []).append(elapsed)
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+
+def _percentile(samples: list[float], percent: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * percent), len(ordered) - 1)]
+
+
+def run_case(
+    server: FakeServer,
+    recorder: PhaseRecorder,
+    account_count: int,
+    course_count: int,
+    args,
+):
+    server.course_count = course_count
+    server.expire_sessions()
+    with tempfile.TemporaryDirectory() as data_dir:
+        pushers = []
+        if args.push:
+            pushers.append(
+                {
+                    "type": "telegram",
+                    "token": "bench",
+                    "chat_id": "1",
+                    "api_base": server.telegram_api_base,
+                }
+            )
+        config = GlobalConfig(
+            data_dir=data_dir,
+            accounts=[
+                AccountConfig(username=f"B{i:08d}", password="password")
+                for i in range(account_count)
+            ],
+            pushers=pushers,
+            url_overrides=server.url_overrides,
+            max_workers=args.workers,
+            push_batch=BatchConfig(enabled=not args.no_batch, max_items=1000),
+            incremental=IncrementalConfig(enabled=args.incremental),
+        )
+        for cycle in range(1, args.cycles + 1):
+            recorder.reset()
+            request_count = server.request_count
+            sent_count = len(server.sent_messages)
+            throttled_count = server.telegram_throttled
+            start = time.perf_counter()
+            app_main(config, argparse.Namespace(oneshot=True))
+            elapsed = time.perf_counter() - start
+            print(
+                f"accounts={account_count} courses={course_count} cycle={cycle}: "
+                f"{elapsed:.3f}s, {account_count / elapsed:.2f} accounts/s, "
+                f"{account_count * course_count / elapsed:.0f} courses/s, "
+                f"{server.request_count - request_count} requests"
+            )
+            if args.push:
+                print(
+                    f"    {len(server.sent_messages) - sent_count} message(s) pushed, "
+                    f"{server.telegram_throttled - throttled_count} throttled"
+                )
+            for name, samples in sorted(recorder.samples.items()):
+                print(
+                    f"    {name:<16} n={len(samples):<4} "
+                    f"mean={statistics.mean(samples) * 1000:>9.2f}ms "
+                    f"p95={_percentile(samples, 0.95) * 1000:>9.2f}ms "
+                    f"total={sum(samples) * 1000:>10.2f}ms"
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end scrape benchmark")
+    parser.add_argument("--accounts", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--courses", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--cycles",
+        type=int,
+        default=2,
+        help="Cycles per case, the first one logs in and sees every course as new",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Server time per request (s)"
+    )
+    parser.add_argument(
+        "--captcha-reject-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of logins rejected for a wrong captcha",
+    )
+    parser.add_argument(
+        "--push", action="store_true", help="Push to the fake Telegram Bot API"
+    )
+    parser.add_argument(
+        "--no-batch", action="store_true", help="Push each change separately"
+    )
+    parser.add_argument(
+        "--telegram-limit",
+        type=int,
+        default=0,
+        help="Messages per second accepted by the fake Telegram Bot API",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Query only the active term after the first (full) cycle",
+    )
+    parser.add_argument("--debug", action="store_true", help="Show scraper logs")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+
+    server = FakeServer(
+        latency=args.latency, captcha_reject_rate=args.captcha_reject_rate
+    )
+    server.telegram_limit = args.telegram_limit
+    server.start()
+    recorder = PhaseRecorder()
+    add_phase_observer(recorder)
+    try:
+        for account_count in args.accounts:
+            for course_count in args.courses:
+                run_case(server, recorder, account_count, course_count, args)
+    finally:
+        remove_phase_observer(recorder)
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
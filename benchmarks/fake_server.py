@@ -0,0 +1,382 @@
+# A local stand-in for the SSO, the EAS and the Telegram Bot API, serving just
+# enough of each for a full scrape cycle. Point the scraper at it with
+# `url_overrides` (see `FakeServer.url_overrides`) and `api_base` of pushers.
+import base64
+import html
+import io
+import json
+import random
+import secrets
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from njupt_score_pusher.njupt_eas import SCORE_GRID_HEADERS
+from benchmarks.fixtures import (
+    encode_view_state,
+    generate_score_rows,
+    generate_score_view_state,
+)
+
+NAME = "测试"
+VIEW_STATE_GENERATOR = "8963BEEC"
+
+
+def _captcha_image() -> bytes:
+    # Pillow comes with ddddocr
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (100, 40), "white")
+    ImageDraw.Draw(image).text((20, 12), "a7k2", fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG")
+    return buffer.getvalue()
+
+
+class FakeServer:
+    def __init__(
+        self,
+        course_count: int = 60,
+        latency: float = 0.0,
+        captcha_reject_rate: float = 0.0,
+    ):
+        self.course_count = course_count
+        # Simulated server time per request, in seconds
+        self.latency = latency
+        self.captcha_reject_rate = captcha_reject_rate
+        self.lock = threading.Lock()
+        self.sso_tokens: set[str] = set()
+        self.eas_tokens: set[str] = set()
+        self.request_count = 0
+        self.sent_messages: list[str] = []
+        # Messages per second accepted by the Telegram Bot API, 0 for no limit
+        self.telegram_limit = 0
+        self.telegram_sent_at: list[float] = []
+        self.telegram_throttled = 0
+        self.captcha_image = _captcha_image()
+        # (course count, school year, term) -> view state
+        self.view_states: dict[tuple[int, str, str], str] = {}
+        self.initial_view_state = encode_view_state({"t": ["-1234567890", ""]})
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self.__handler_class())
+        self.httpd.daemon_threads = True
+        self.thread: threading.Thread | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    @property
+    def url_overrides(self) -> dict[str, str]:
+        return {
+            "https://i.njupt.edu.cn": f"{self.base_url}/sso",
+            "http://jwxt.njupt.edu.cn": f"{self.base_url}/jwxt",
+            # Not served, so that the path probe always picks Direct
+            "https://vpn.njupt.edu.cn:8443": f"{self.base_url}/webvpn",
+        }
+
+    @property
+    def telegram_api_base(self) -> str:
+        return f"{self.base_url}/telegram"
+
+    def score_rows(self, year: str = "", term: str = "") -> list[list[str]]:
+        # Filtered like the EAS does for ddlXN/ddlXQ, empty for all terms
+        return [
+            row
+            for row in generate_score_rows(self.course_count)
+            if year in ("", row[0]) and term in ("", row[1])
+        ]
+
+    def active_term(self) -> tuple[str, str]:
+        # The latest term, selected on the score page by default
+        return max((row[0], row[1]) for row in generate_score_rows(self.course_count))
+
+    def score_view_state(self, year: str = "", term: str = "") -> str:
+        key = (self.course_count, year, term)
+        with self.lock:
+            if key not in self.view_states:
+                self.view_states[key] = generate_score_view_state(
+                    self.score_rows(year, term)
+                )
+            return self.view_states[key]
+
+    def rotate_form_state(self):
+        # Rejects the view state of score pages served before
+        with self.lock:
+            self.initial_view_state = encode_view_state(
+                {"t": [str(-random.randrange(10**9, 10**10)), ""]}
+            )
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sso_tokens.clear()
+            self.eas_tokens.clear()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, name="fake-server", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                server.handle(self, "GET")
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                server.handle(self, "POST")
+
+        return Handler
+
+    def handle(self, handler: BaseHTTPRequestHandler, method: str):
+        with self.lock:
+            self.request_count += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        url = urllib.parse.urlsplit(handler.path)
+        query = urllib.parse.parse_qs(url.query)
+        body = b""
+        if method == "POST":
+            body = handler.rfile.read(int(handler.headers.get("Content-Length", 0)))
+        cookies = self.__cookies(handler)
+        path = url.path
+        if path.startswith("/sso"):
+            self.__handle_sso(handler, method, path[4:], query, body, cookies)
+        elif path.startswith("/jwxt"):
+            self.__handle_eas(handler, method, path[5:], query, body, cookies)
+        elif path.startswith("/telegram"):
+            self.__handle_telegram(handler, query, body)
+        else:
+            self.__respond(handler, 404, b"Not Found")
+
+    def __handle_sso(self, handler, method, path, query, body, cookies):
+        if path == "/" or path == "":
+            self.__respond(handler, 200, b"<html>SSO</html>", "text/html")
+        elif path.startswith("/ssoLogin/getCaptchaStatus/"):
+            self.__respond_json(handler, {"success": False})
+        elif path.startswith("/sys/randomImage/"):
+            data_uri = "data:image/jpg;base64," + base64.b64encode(
+                self.captcha_image
+            ).decode("ascii")
+            self.__respond_json(handler, {"success": True, "result": data_uri})
+        elif path == "/ssoLogin/login" and method == "POST":
+            form = urllib.parse.parse_qs(body.decode("ascii"))
+            if "username" not in form or "checkKey" not in form:
+                self.__respond_json(
+                    handler, {"success": False, "code": 400, "message": "参数错误"}
+                )
+            elif random.random() < self.captcha_reject_rate:
+                self.__respond_json(
+                    handler, {"success": False, "code": 500, "message": "验证码错误"}
+                )
+            else:
+                token = secrets.token_hex(8)
+                with self.lock:
+                    self.sso_tokens.add(token)
+                self.__respond_json(
+                    handler,
+                    {"success": True},
+                    headers={"Set-Cookie": f"SSO_TOKEN={token}; Path=/"},
+                )
+        elif path == "/cas/login":
+            service = query.get("service", [""])[0]
+            with self.lock:
+                valid = cookies.get("SSO_TOKEN") in self.sso_tokens
+            if not valid:
+                self.__respond(handler, 401, b"Unauthorized")
+            else:
+                ticket = "ST-" + secrets.token_hex(8)
+                self.__respond(
+                    handler,
+                    302,
+                    b"",
+                    headers={"Location": f"{service}?ticket={ticket}"},
+                )
+        else:
+            self.__respond(handler, 404, b"Not Found")
+
+    def __handle_eas(self, handler, method, path, query, body, cookies):
+        if path == "/login_cas.aspx":
+            if "ticket" not in query:
+                self.__respond(handler, 400, b"Bad Request")
+                return
+            token = secrets.token_hex(8)
+            with self.lock:
+                self.eas_tokens.add(token)
+            self.__respond(
+                handler,
+                200,
+                b"<html>OK</html>",
+                "text/html",
+                headers={"Set-Cookie": f"ASP.NET_SessionId={token}; Path=/"},
+            )
+            return
+        with self.lock:
+            valid = cookies.get("ASP.NET_SessionId") in self.eas_tokens
+        if not valid:
+            self.__respond(
+                handler,
+                302,
+                b"",
+                headers={"Location": "http://jwxt.njupt.edu.cn/default2.aspx"},
+            )
+        elif path == "/xs_main.aspx":
+            page = f'<html><em><span id="xhxm">{NAME}同学</span></em></html>'
+            self.__respond_page(handler, page)
+        elif path == "/xscj_gc.aspx" and method == "GET":
+            self.__respond_page(
+                handler,
+                self.__score_page(
+                    self.initial_view_state, selected_term=self.active_term()
+                ),
+            )
+        elif path == "/xscj_gc.aspx" and method == "POST":
+            form = urllib.parse.parse_qs(body.decode("ascii"), encoding="gb18030")
+            # Like a MAC check failure of ASP.NET
+            if form.get("__VIEWSTATE", [""])[0] != self.initial_view_state:
+                self.__respond(handler, 500, b"Server Error")
+                return
+            year, term = "", ""
+            if "Button1" in form or "Button5" in form:
+                year = form.get("ddlXN", [""])[0]
+            if "Button1" in form:
+                term = form.get("ddlXQ", [""])[0]
+            self.__respond_page(
+                handler,
+                self.__score_page(
+                    self.score_view_state(year, term),
+                    self.score_rows(year, term),
+                    (year, term),
+                ),
+            )
+        else:
+            self.__respond(handler, 404, b"Not Found")
+
+    def __handle_telegram(self, handler, query, body):
+        params = query
+        if len(body) != 0:
+            params = urllib.parse.parse_qs(body.decode("utf-8"))
+        text = params.get("text", [""])[0]
+        with self.lock:
+            now = time.monotonic()
+            self.telegram_sent_at = [x for x in self.telegram_sent_at if x > now - 1]
+            throttled = 0 < self.telegram_limit <= len(self.telegram_sent_at)
+            if throttled:
+                self.telegram_throttled += 1
+            else:
+                self.telegram_sent_at.append(now)
+                self.sent_messages.append(text)
+        if throttled:
+            self.__respond_json(
+                handler,
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                },
+                status=429,
+            )
+            return
+        self.__respond_json(handler, {"ok": True, "result": {}})
+
+    @staticmethod
+    def __score_page(
+        view_state: str,
+        rows: list[list[str]] | None = None,
+        selected_term: tuple[str, str] = ("", ""),
+    ) -> str:
+        parts = [
+            '<html><body><form name="Form1" method="post" action="xscj_gc.aspx">',
+            f'<input type="hidden" name="__VIEWSTATE" value="{view_state}" />',
+            '<input type="hidden" name="__VIEWSTATEGENERATOR" '
+            f'value="{VIEW_STATE_GENERATOR}" />',
+        ]
+        for name, selected in zip(("ddlXN", "ddlXQ"), selected_term):
+            parts.append(f'<select name="{name}" id="{name}">')
+            parts.append('<option value=""></option>')
+            if selected != "":
+                parts.append(
+                    f'<option selected="selected" value="{selected}">{selected}'
+                    "</option>"
+                )
+            parts.append("</select>")
+        if rows is not None:
+            parts.append(FakeServer.render_score_grid(rows))
+        parts.append("</form></body></html>")
+        return "\n".join(parts)
+
+    @staticmethod
+    def render_score_grid(rows: list[list[str]]) -> str:
+        lines = [
+            '<table class="datelist" cellspacing="0" cellpadding="3" border="0" '
+            'id="Datagrid1" width="100%">',
+            '\t<tr class="datelisthead">',
+        ]
+        lines.extend(f"\t\t<td>{header}</td>" for header in SCORE_GRID_HEADERS)
+        lines.append("\t</tr>")
+        for i, row in enumerate(rows):
+            lines.append('\t<tr class="alt">' if i % 2 else "\t<tr>")
+            lines.extend(
+                f"\t\t<td>{text if text == '&nbsp;' else html.escape(text)}</td>"
+                for text in row
+            )
+            lines.append("\t</tr>")
+        lines.append("</table>")
+        return "\n".join(lines)
+
+    @staticmethod
+    def __cookies(handler: BaseHTTPRequestHandler) -> dict[str, str]:
+        cookies = {}
+        for item in handler.headers.get("Cookie", "").split(";"):
+            if "=" in item:
+                key, value = item.strip().split("=", 1)
+                cookies[key] = value
+        return cookies
+
+    def __respond_page(self, handler, page: str):
+        self.__respond(
+            handler, 200, page.encode("gb18030"), "text/html; charset=gb2312"
+        )
+
+    def __respond_json(
+        self,
+        handler,
+        data,
+        headers: dict[str, str] | None = None,
+        status: int = 200,
+    ):
+        self.__respond(
+            handler,
+            status,
+            json.dumps(data, ensure_ascii=False).encode("utf-8"),
+            "application/json;charset=UTF-8",
+            headers,
+        )
+
+    @staticmethod
+    def __respond(
+        handler: BaseHTTPRequestHandler,
+        status: int,
+        body: bytes,
+        content_type: str = "text/plain",
+        headers: dict[str, str] | None = None,
+    ):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(body)
@@ -0,0 +1,94 @@
+import base64
+import hashlib
+import random
+
+__COURSE_NATURES = ("必修课", "选修课", "公共基础课", "学科基础课")
+__SCORES = ("优秀", "良好", "中等", "及格", "不及格")
+
+
+def generate_score_rows(course_count: int, seed: int = 0) -> list[list[str]]:
+    rng = random.Random(seed)
+    rows = []
+    for i in range(course_count):
+        year = 2020 + (i // 20) % 8
+        if rng.random() < 0.7:
+            score_value = rng.randint(55, 100)
+            score = str(score_value)
+            gpa = max(0.0, (score_value - 50) / 10)
+        else:
+            score = rng.choice(__SCORES)
+            gpa = float(4 - __SCORES.index(score))
+        row = [
+            f"{year}-{year + 1}",
+            str(i // 10 % 2 + 1),
+            f"B{i:07d}",
+            f"课程{i}",
+            rng.choice(__COURSE_NATURES),
+            "&nbsp;",
+            f"{rng.choice((1, 1.5, 2, 3, 4)):.1f}",
+            f"{gpa:.2f}",
+            "&nbsp;",
+            "&nbsp;",
+            "&nbsp;",
+            "&nbsp;",
+            "&nbsp;",
+            score,
+            "0",
+            "&nbsp;",
+            "&nbsp;",
+            "0",
+            "计算机学院",
+            "&nbsp;",
+            "0",
+            f"Course {i}",
+        ]
+        rows.append(row)
+    return rows
+
+
+def __encode_node(node, parts: list[str]):
+    if isinstance(node, dict):
+        ((key, children),) = node.items()
+        parts.append(__escape(key))
+        parts.append("<")
+        for i, child in enumerate(children):
+            if i != 0:
+                parts.append(";")
+            __encode_node(child, parts)
+        parts.append(">")
+    else:
+        parts.append(__escape(node))
+
+
+def __escape(text: str) -> str:
+    for char in "\\<>;":
+        text = text.replace(char, "\\" + char)
+    return text
+
+
+def encode_view_state(tree) -> str:
+    parts: list[str] = []
+    __encode_node(tree, parts)
+    payload = "".join(parts).encode("utf-8")
+    # Stands in for the MAC appended by ASP.NET
+    payload += hashlib.sha1(payload).digest()
+    return base64.b64encode(payload).decode("ascii")
+
+
+def generate_score_view_state(rows: list[list[str]]) -> str:
+    def cell(text: str):
+        return {"t": [{"p": [{"p": ["Text", {"l": [text]}]}]}]}
+
+    def control(children: list):
+        return {"t": ["", "", {"l": children}]}
+
+    grid_rows = []
+    for row in rows:
+        cells: list = []
+        for text in row:
+            cells.append(cell(text))
+            cells.append("")
+        grid_rows.append(control(cells))
+    grid = control([control(grid_rows)])
+    form = control([""] * 13 + [grid])
+    return encode_view_state({"t": ["-1234567890", control([form])]})
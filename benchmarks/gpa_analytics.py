@@ -0,0 +1,106 @@
+# Compares attaching the GPA figures to a batch of changes incrementally with
+# recomputing them over the whole transcript for every message.
+# Usage: python -m benchmarks.gpa_analytics [--courses 60 600 3000]
+import argparse
+import dataclasses
+import sys
+import time
+
+from njupt_score_pusher.analytics import (
+    ELECTIVE,
+    REQUIRED,
+    attach_summaries,
+    course_category,
+    is_counted,
+    weighted_gpa,
+)
+from njupt_score_pusher.njupt_eas import NjuptEduAdminSystem
+from njupt_score_pusher.score_diff import diff_scores
+from benchmarks.fixtures import generate_score_rows, generate_score_view_state
+
+
+def generate_courses(course_count: int, seed: int = 0):
+    view_state = generate_score_view_state(generate_score_rows(course_count, seed))
+    return list(NjuptEduAdminSystem.parse_score(view_state))
+
+
+def recompute(courses) -> tuple[float, float, float, float]:
+    # The straightforward version: every figure from scratch
+    total = [0.0, 0.0]
+    category = {REQUIRED: [0.0, 0.0], ELECTIVE: [0.0, 0.0]}
+    earned = 0.0
+    for course in courses:
+        if not is_counted(course):
+            continue
+        total[0] += course.credit * course.gpa
+        total[1] += course.credit
+        category[course_category(course)][0] += course.credit * course.gpa
+        category[course_category(course)][1] += course.credit
+        if course.gpa > 0:
+            earned += course.credit
+    return (
+        weighted_gpa(*total),
+        weighted_gpa(*category[REQUIRED]),
+        weighted_gpa(*category[ELECTIVE]),
+        earned,
+    )
+
+
+def recompute_all(prev, changes):
+    current = {x.id(): x for x in prev}
+    figures = []
+    for change in changes:
+        if change.type.name == "REMOVED":
+            current.pop(change.content.id(), None)
+        else:
+            current[change.content.id()] = change.content
+        figures.append(recompute(current.values()))
+    return figures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the GPA analytics")
+    parser.add_argument("--courses", type=int, nargs="+", default=[60, 600, 3000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'courses':>8} {'changes':>8} {'recompute':>10} {'incremental':>12}")
+    for course_count in args.courses:
+        new = generate_courses(course_count)
+        # The last courses are new, with a few updated and removed ones besides
+        prev = new[: course_count * 9 // 10]
+        for i in range(0, len(prev), 20):
+            prev[i] = dataclasses.replace(prev[i], gpa=4.0 - prev[i].gpa)
+        prev += [
+            dataclasses.replace(x, course_code="X" + x.course_code)
+            for x in generate_courses(course_count // 20, seed=1)
+        ]
+        changes = diff_scores(prev, new)
+        recompute_elapsed = incremental_elapsed = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            expected = recompute_all(prev, changes)
+            recompute_elapsed = min(recompute_elapsed, time.perf_counter() - start)
+            start = time.perf_counter()
+            attach_summaries(prev, changes)
+            incremental_elapsed = min(incremental_elapsed, time.perf_counter() - start)
+        for change, figures in zip(changes, expected):
+            summary = change.summary
+            assert summary is not None
+            actual = (
+                summary.gpa,
+                summary.required_gpa,
+                summary.elective_gpa,
+                summary.credits_earned,
+            )
+            if any(abs(x - y) > 1e-3 for x, y in zip(actual, figures)):
+                print(f"Incremental figures disagree: {actual} != {figures}")
+                sys.exit(1)
+        print(
+            f"{course_count:>8} {len(changes):>8}"
+            f" {recompute_elapsed * 1000:>8.1f}ms {incremental_elapsed * 1000:>10.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
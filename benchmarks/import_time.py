@@ -0,0 +1,74 @@
+# Import time of the modules loaded at startup, measured with `-X importtime`
+# in fresh interpreters, so that cold starts of oneshot runs stay fast.
+# Usage: python -m benchmarks.import_time [--module njupt_score_pusher.app]
+#        [--budget 0.3]
+import argparse
+import subprocess
+import sys
+
+# Only needed for a login or for other features, never at startup
+HEAVY_MODULES = ("Crypto", "ddddocr", "onnxruntime", "numpy", "PIL")
+
+
+def measure(module: str) -> list[tuple[str, int, int]]:
+    # Returns (module, self us, cumulative us) in import order
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    records = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        records.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup imports")
+    parser.add_argument("--module", default="njupt_score_pusher.app")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="Fail if importing the module takes longer (seconds)",
+    )
+    args = parser.parse_args()
+
+    best: list[tuple[str, int, int]] = []
+    best_total = None
+    for _ in range(args.repeat):
+        records = measure(args.module)
+        total = next(
+            cumulative for name, _, cumulative in records if name == args.module
+        )
+        if best_total is None or total < best_total:
+            best, best_total = records, total
+    assert best_total is not None
+
+    print(f"{'self':>10} {'cumulative':>12}  module")
+    for name, self_time, cumulative in sorted(best, key=lambda x: -x[2])[: args.top]:
+        print(f"{self_time / 1000:>8.1f}ms {cumulative / 1000:>10.1f}ms  {name}")
+    print(f"{args.module}: {best_total / 1000:.1f}ms (best of {args.repeat})")
+
+    failed = False
+    heavy = sorted(name for name, _, _ in best if name.split(".")[0] in HEAVY_MODULES)
+    if len(heavy) != 0:
+        print(f"Heavy modules imported at startup: {', '.join(heavy[:10])}")
+        failed = True
+    if args.budget is not None and best_total / 1e6 > args.budget:
+        print(f"Budget exceeded: {best_total / 1e6:.3f}s > {args.budget:.3f}s")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
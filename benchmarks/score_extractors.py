@@ -0,0 +1,108 @@
+# Compares the two ways of reading the courses from a result page: decoding
+# the __VIEWSTATE, or extracting the rendered HTML grid.
+# Usage: python -m benchmarks.score_extractors [--courses 60 600 3000]
+import argparse
+import sys
+import time
+
+from njupt_score_pusher.njupt_eas import (
+    SCORE_GRID_HEADERS,
+    VIEW_STATE_PATTERN,
+    NjuptEduAdminSystem,
+    ScoreGridExtractor,
+)
+from benchmarks.fake_server import FakeServer
+from benchmarks.fixtures import generate_score_rows, generate_score_view_state
+
+CHUNK_SIZE = 64 * 1024
+
+
+def render_page(view_state: str, grid: str) -> str:
+    return (
+        '<html><body><form name="Form1" method="post" action="xscj_gc.aspx">\n'
+        f'<input type="hidden" name="__VIEWSTATE" value="{view_state}" />\n'
+        f"{grid}\n</form></body></html>"
+    )
+
+
+def extract_view_state(page: str):
+    match = VIEW_STATE_PATTERN.search(page)
+    assert match is not None
+    return NjuptEduAdminSystem.parse_score(match.group(1))
+
+
+def extract_html(page: str):
+    # Fed in chunks like a streamed response
+    extractor = ScoreGridExtractor()
+    for i in range(0, len(page), CHUNK_SIZE):
+        extractor.feed(page[i : i + CHUNK_SIZE])
+    extractor.close()
+    return tuple(extractor.courses)
+
+
+def measure(func, page: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(page)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def check_layout_change(course_count: int) -> tuple[bool, bool]:
+    # Moves the score column to the end and adds an unknown column, returns
+    # whether each extractor still reads the same courses
+    rows = generate_score_rows(course_count)
+    expected = extract_html(
+        render_page(generate_score_view_state(rows), FakeServer.render_score_grid(rows))
+    )
+    order = [i for i in range(len(SCORE_GRID_HEADERS)) if i != 13] + [13]
+    changed_rows = [[row[i] for i in order] + ["x"] for row in rows]
+    grid = FakeServer.render_score_grid(changed_rows).replace(
+        "".join(f"\t\t<td>{header}</td>\n" for header in SCORE_GRID_HEADERS),
+        "".join(f"\t\t<td>{SCORE_GRID_HEADERS[i]}</td>\n" for i in order)
+        + "\t\t<td>新列</td>\n",
+    )
+    page = render_page(generate_score_view_state(changed_rows), grid)
+    try:
+        view_state_ok = extract_view_state(page) == expected
+    except (ValueError, IndexError, KeyError):
+        view_state_ok = False
+    return view_state_ok, extract_html(page) == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the score extractors")
+    parser.add_argument("--courses", type=int, nargs="+", default=[60, 600, 3000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'courses':>8} {'size':>10} {'view_state':>11} {'html':>10} {'speedup':>8}")
+    for course_count in args.courses:
+        rows = generate_score_rows(course_count)
+        page = render_page(
+            generate_score_view_state(rows), FakeServer.render_score_grid(rows)
+        )
+        if extract_view_state(page) != extract_html(page):
+            print("Extractors disagree on the generated page")
+            sys.exit(1)
+        view_state_elapsed = measure(extract_view_state, page, args.repeat)
+        html_elapsed = measure(extract_html, page, args.repeat)
+        print(
+            f"{course_count:>8} {len(page) // 1024:>8}KB"
+            f" {view_state_elapsed * 1000:>9.1f}ms {html_elapsed * 1000:>8.1f}ms"
+            f" {view_state_elapsed / html_elapsed:>7.1f}x"
+        )
+
+    view_state_ok, html_ok = check_layout_change(args.courses[0])
+    print(
+        "Reordered and added columns: "
+        f"view_state {'ok' if view_state_ok else 'wrong'}, "
+        f"html {'ok' if html_ok else 'wrong'}"
+    )
+    if not html_ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Micro-benchmark of the __VIEWSTATE parser on synthetic transcripts.
+# Usage: python -m benchmarks.view_state [--courses 60 600 3000] [--budget 0.5]
+import argparse
+import base64
+import sys
+import time
+
+from njupt_score_pusher.njupt_eas import parse_view_state
+from benchmarks.fixtures import generate_score_rows, generate_score_view_state
+
+
+def legacy_parse_view_state(view_state: str):
+    # The char-by-char parser used before the streaming tokenizer, kept as the
+    # reference for correctness and speed
+    tag_string = base64.b64decode(view_state)[0:-20].decode("utf-8")
+    tag = ""
+    values = []
+    stack = []
+    is_escaped = False
+    skip_next_semicolon = False
+    for char in tag_string:
+        if skip_next_semicolon:
+            skip_next_semicolon = False
+            if char == ";":
+                continue
+        if is_escaped:
+            tag += char
+            is_escaped = False
+        elif char == "\\":
+            is_escaped = True
+        elif char == "<":
+            stack.append((tag, len(values)))
+            tag = ""
+        elif char == ">":
+            values.append(tag)
+            tag = ""
+            prev_tag, prev_length = stack.pop()
+            values = values[:prev_length] + [{prev_tag: values[prev_length:]}]
+            skip_next_semicolon = True
+        elif char == ";":
+            values.append(tag)
+            tag = ""
+        else:
+            tag += char
+    if tag != "":
+        values.append(tag)
+    return values[0]
+
+
+def measure(func, view_state: str, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(view_state)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VIEWSTATE parser")
+    parser.add_argument("--courses", type=int, nargs="+", default=[60, 600, 3000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--no-legacy", action="store_true", help="Skip the legacy parser"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="Fail if parsing the largest transcript takes longer (seconds)",
+    )
+    args = parser.parse_args()
+
+    print(f"{'courses':>8} {'size':>10} {'legacy':>10} {'current':>10} {'speedup':>8}")
+    elapsed = 0.0
+    for course_count in args.courses:
+        view_state = generate_score_view_state(generate_score_rows(course_count))
+        elapsed = measure(parse_view_state, view_state, args.repeat)
+        if args.no_legacy:
+            legacy_text = "-"
+            speedup_text = "-"
+        else:
+            if legacy_parse_view_state(view_state) != parse_view_state(view_state):
+                print("Parsers disagree on the generated view state")
+                sys.exit(1)
+            legacy_elapsed = measure(legacy_parse_view_state, view_state, args.repeat)
+            legacy_text = f"{legacy_elapsed * 1000:.1f}ms"
+            speedup_text = f"{legacy_elapsed / elapsed:.1f}x"
+        print(
+            f"{course_count:>8} {len(view_state) // 1024:>8}KB {legacy_text:>10}"
+            f" {elapsed * 1000:>8.1f}ms {speedup_text:>8}"
+        )
+    if args.budget is not None and elapsed > args.budget:
+        print(f"Budget exceeded: {elapsed:.3f}s > {args.budget:.3f}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,6 @@
 import os
 import argparse
 import logging
-import json
-import dacite
 
 
 def main():
@@ -18,6 +16,14 @@ def main():
     )
     parser.add_argument("--dry", action="store_true", help="Dry run (no push)")
     parser.add_argument("--oneshot", action="store_true", help="Oneshot mode")
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="cpu",
+        choices=["cpu", "memory"],
+        help="Run a single cycle under cProfile (cpu) or tracemalloc (memory) "
+        "and write the results to the data directory",
+    )
     parser.add_argument("--debug", action="store_true", help="Debug mode")
     parser.add_argument("--version", action="version", version="%(prog)s 1.0")
     args = parser.parse_args()
@@ -33,14 +39,11 @@ def main():
         logging.error("Configuration file not found")
         return
 
-    from njupt_score_pusher.app import GlobalConfig, app_main
+    from njupt_score_pusher.app import app_main, load_global_config
 
-    with open(args.config, "r", encoding="utf-8") as f:
-        config = json.load(f)
-        global_config = dacite.from_dict(GlobalConfig, config)
-        if args.dry:
-            logging.info("Dry run enabled")
-            global_config.pushers = []
+    global_config = load_global_config(args.config, args.dry)
+    if args.dry:
+        logging.info("Dry run enabled")
     app_main(global_config, args)
 
 
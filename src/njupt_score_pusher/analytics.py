@@ -0,0 +1,177 @@
+import logging
+from typing import Iterable
+import numpy as np
+from njupt_score_pusher.njupt_eas import CourseScoreInfo
+from njupt_score_pusher.pusher.entity import GpaSummary, MessageEntity, MessageType
+
+logger = logging.getLogger(__name__)
+
+# Category indexes of the per-category sums
+REQUIRED = 0
+ELECTIVE = 1
+
+
+def course_category(course: CourseScoreInfo) -> int:
+    # 课程性质 is e.g. 必修课, 公共选修课, 专业选修课
+    return ELECTIVE if "选修" in course.course_nature else REQUIRED
+
+
+def is_counted(course: CourseScoreInfo) -> bool:
+    # Minor courses are not part of the major GPA
+    return not course.minor_flag and course.credit > 0
+
+
+def weighted_gpa(points: float, credits: float) -> float:
+    return points / credits if credits > 0 else 0.0
+
+
+# Keeps the snapshot in columns (one array per field, one row per course) along
+# with the credit and grade point sums of every term and category, so that a
+# change only touches its own row and the sums it contributes to
+class TranscriptAnalytics:
+    def __init__(self, courses: Iterable[CourseScoreInfo]):
+        # Keyed by id like `diff_scores`, the last one wins
+        courses = list({x.id(): x for x in courses}.values())
+        self.__rows = {x.id(): i for i, x in enumerate(courses)}
+        self.__terms: dict[str, int] = {}
+        capacity = max(len(courses), 16)
+        self.__size = len(courses)
+        self.__credit = np.zeros(capacity, dtype=np.float64)
+        self.__gpa = np.zeros(capacity, dtype=np.float64)
+        self.__counted = np.zeros(capacity, dtype=np.bool_)
+        self.__term = np.zeros(capacity, dtype=np.int32)
+        self.__category = np.zeros(capacity, dtype=np.int8)
+        n = self.__size
+        self.__credit[:n] = [x.credit for x in courses]
+        self.__gpa[:n] = [x.gpa for x in courses]
+        self.__counted[:n] = [is_counted(x) for x in courses]
+        self.__term[:n] = [self.__term_index(x) for x in courses]
+        self.__category[:n] = [course_category(x) for x in courses]
+
+        weights = np.where(self.__counted[:n], self.__credit[:n], 0.0)
+        points = weights * self.__gpa[:n]
+        earned = np.where(self.__gpa[:n] > 0, weights, 0.0)
+        terms, categories = self.__term[:n], self.__category[:n]
+        self.__term_credits = np.bincount(terms, weights, len(self.__terms))
+        self.__term_points = np.bincount(terms, points, len(self.__terms))
+        self.__category_credits = np.bincount(categories, weights, 2)
+        self.__category_points = np.bincount(categories, points, 2)
+        self.__earned = float(earned.sum())
+
+    def __term_index(self, course: CourseScoreInfo) -> int:
+        key = f"{course.year}-{course.term}"
+        index = self.__terms.get(key)
+        if index is None:
+            index = len(self.__terms)
+            self.__terms[key] = index
+        return index
+
+    def __contribute(self, row: int, sign: float):
+        if not self.__counted[row]:
+            return
+        credit = self.__credit[row] * sign
+        points = credit * self.__gpa[row]
+        self.__term_credits[self.__term[row]] += credit
+        self.__term_points[self.__term[row]] += points
+        self.__category_credits[self.__category[row]] += credit
+        self.__category_points[self.__category[row]] += points
+        if self.__gpa[row] > 0:
+            self.__earned += float(credit)
+
+    def __put(self, course: CourseScoreInfo):
+        row = self.__rows.get(course.id())
+        if row is None:
+            if self.__size == len(self.__credit):
+                self.__grow()
+            row = self.__size
+            self.__size += 1
+            self.__rows[course.id()] = row
+        else:
+            self.__contribute(row, -1.0)
+        self.__credit[row] = course.credit
+        self.__gpa[row] = course.gpa
+        self.__counted[row] = is_counted(course)
+        self.__term[row] = self.__term_index(course)
+        if len(self.__terms) > len(self.__term_credits):
+            self.__term_credits = np.append(self.__term_credits, 0.0)
+            self.__term_points = np.append(self.__term_points, 0.0)
+        self.__category[row] = course_category(course)
+        self.__contribute(row, 1.0)
+
+    def __remove(self, course: CourseScoreInfo):
+        row = self.__rows.get(course.id())
+        if row is None:
+            logger.warning("Removing unknown course %s", course.id())
+            return
+        self.__contribute(row, -1.0)
+        # Rows are left in place, only excluded from the sums
+        self.__counted[row] = False
+
+    def __grow(self):
+        # Doubles the capacity so that appending rows is amortized O(1)
+        capacity = len(self.__credit) * 2
+        self.__credit = self.__grown(self.__credit, capacity)
+        self.__gpa = self.__grown(self.__gpa, capacity)
+        self.__counted = self.__grown(self.__counted, capacity)
+        self.__term = self.__grown(self.__term, capacity)
+        self.__category = self.__grown(self.__category, capacity)
+
+    @staticmethod
+    def __grown(column: np.ndarray, capacity: int) -> np.ndarray:
+        grown = np.zeros(capacity, dtype=column.dtype)
+        grown[: len(column)] = column
+        return grown
+
+    def gpa(self) -> float:
+        return weighted_gpa(
+            float(self.__term_points.sum()), float(self.__term_credits.sum())
+        )
+
+    def term_gpa(self, year: str, term: str) -> float:
+        index = self.__terms.get(f"{year}-{term}")
+        if index is None:
+            return 0.0
+        return weighted_gpa(
+            float(self.__term_points[index]), float(self.__term_credits[index])
+        )
+
+    def category_gpa(self, category: int) -> float:
+        return weighted_gpa(
+            float(self.__category_points[category]),
+            float(self.__category_credits[category]),
+        )
+
+    def credits_earned(self) -> float:
+        return self.__earned
+
+    def apply(self, change: MessageEntity) -> GpaSummary:
+        # Applies a single change and reports how it moved the GPA
+        course = change.content
+        gpa_before = self.gpa()
+        term_gpa_before = self.term_gpa(course.year, course.term)
+        if change.type == MessageType.REMOVED:
+            self.__remove(course)
+        else:
+            if change.prev is not None and change.prev.id() != course.id():
+                self.__remove(change.prev)
+            self.__put(course)
+        return GpaSummary(
+            gpa_before=round(gpa_before, 4),
+            gpa=round(self.gpa(), 4),
+            term_gpa_before=round(term_gpa_before, 4),
+            term_gpa=round(self.term_gpa(course.year, course.term), 4),
+            required_gpa=round(self.category_gpa(REQUIRED), 4),
+            elective_gpa=round(self.category_gpa(ELECTIVE), 4),
+            credits_earned=round(self.credits_earned(), 2),
+        )
+
+
+def attach_summaries(
+    snapshot: Iterable[CourseScoreInfo], changes: list[MessageEntity]
+) -> TranscriptAnalytics:
+    # Builds the columns from the previous snapshot once, then walks through the
+    # changes in order so that each message carries the GPA right after it
+    analytics = TranscriptAnalytics(snapshot)
+    for change in changes:
+        change.summary = analytics.apply(change)
+    return analytics
@@ -1,147 +1,758 @@
+import concurrent.futures
 import dataclasses
+import heapq
+import json
 import logging
 import os
-import json
-import random
 import time
 from typing import Any
+import dacite
 import requests
-from njupt_score_pusher.njupt_eas import NjuptEduAdminSystem, CourseScoreInfo
+from njupt_score_pusher import metrics
+from njupt_score_pusher.config_watch import CONFIG_CHECK_INTERVAL, ConfigWatcher
+from njupt_score_pusher.metrics import MetricsConfig, start_metrics_server
+from njupt_score_pusher.njupt_eas import (
+    NjuptEduAdminSystem,
+    ScoreFormState,
+    ScoreResult,
+    TermScope,
+)
 from njupt_score_pusher.njupt_sso import NjuptSso
-from njupt_score_pusher.njupt_web_vpn import NjuptWebVpn
+from njupt_score_pusher.network_path import (
+    NetworkPathConfig,
+    configure_network_paths,
+    get_network_paths,
+    path_name,
+)
+from njupt_score_pusher.ocr import OcrConfig, configure_shared_ocr
+from njupt_score_pusher.phases import phase
+from njupt_score_pusher.query_api import QueryApi, QueryApiConfig, start_query_api
+from njupt_score_pusher.scheduler import (
+    AdaptiveScheduler,
+    RandomizedConfig,
+    SchedulerConfig,
+)
+from njupt_score_pusher.score_diff import diff_scores
+from njupt_score_pusher.session_store import SessionStore
+from njupt_score_pusher.storage import ScoreStore, open_score_store
+from njupt_score_pusher.timeouts import (
+    DeadlineExceeded,
+    TimeoutConfig,
+    TimeoutSession,
+    cycle_deadline,
+)
+from njupt_score_pusher.url_rewrite import mount_url_overrides
 from njupt_score_pusher.pusher.common import (
+    BatchConfig,
     Pusher,
-    do_push,
     build_pushers,
+    pusher_key,
 )
-from njupt_score_pusher.pusher.entity import (
-    MessageEntity,
-    MessageType,
-)
+from njupt_score_pusher.pusher.outbox import Outbox, OutboxConfig, OutboxSender
+from njupt_score_pusher.pusher.entity import MessageType
 
 
 @dataclasses.dataclass
-class RandomizedConfig:
-    min: float
-    max: float
+class AccountConfig:
+    username: str
+    password: str
+    data_dir: str | None = None
+    web_vpn_mode: str | bool | None = None
+    pushers: list[dict[str, Any]] | None = None
 
-    def random(self) -> float:
-        return random.uniform(self.min, self.max)
+
+@dataclasses.dataclass
+class IncrementalConfig:
+    enabled: bool = False
+    # School year (e.g. "2023-2024") and term (e.g. "1") to poll, default to
+    # the ones selected on the score page
+    year: str | None = None
+    term: str | None = None
+    # Seconds between two fetches of the whole transcript
+    full_interval: float = 60 * 60 * 24
+
+    def scope(self) -> TermScope | None:
+        if self.year is None:
+            return None
+        return TermScope(self.year, self.term or "")
 
 
 @dataclasses.dataclass
 class GlobalConfig:
     data_dir: str
-    username: str
-    password: str
+    username: str | None = None
+    password: str | None = None
     web_vpn_mode: str | bool | None = None
     pushers: list[dict[str, Any]] = dataclasses.field(default_factory=list)
     scrape_interval: RandomizedConfig = dataclasses.field(
         default_factory=lambda: RandomizedConfig(60 * 60 * 0.8, 60 * 60 * 1.2)
     )
+    accounts: list[AccountConfig] = dataclasses.field(default_factory=list)
+    max_workers: int = 4
+    worker_mode: str = "thread"
+    start_stagger: RandomizedConfig = dataclasses.field(
+        default_factory=lambda: RandomizedConfig(5, 15)
+    )
+    storage: str = "sqlite"
+    # "view_state" or "html", where the courses are read from
+    score_extractor: str = "view_state"
+    # Attaches the GPA figures to each change, see `analytics`
+    gpa_summary: bool = True
+    incremental: IncrementalConfig = dataclasses.field(
+        default_factory=IncrementalConfig
+    )
+    url_overrides: dict[str, str] = dataclasses.field(default_factory=dict)
+    metrics: MetricsConfig | None = None
+    query_api: QueryApiConfig | None = None
+    scheduler: SchedulerConfig = dataclasses.field(default_factory=SchedulerConfig)
+    push_batch: BatchConfig = dataclasses.field(default_factory=BatchConfig)
+    outbox: OutboxConfig = dataclasses.field(default_factory=OutboxConfig)
+    ocr: OcrConfig = dataclasses.field(default_factory=OcrConfig)
+    captcha_attempts: int = 3
+    network: NetworkPathConfig = dataclasses.field(default_factory=NetworkPathConfig)
+    timeouts: TimeoutConfig = dataclasses.field(default_factory=TimeoutConfig)
+
+    def resolve_accounts(self) -> list[AccountConfig]:
+        accounts = []
+        # The top-level credential is kept as a legacy account, which stores
+        # its data directly in `data_dir`
+        if self.username is not None and self.password is not None:
+            accounts.append(
+                AccountConfig(
+                    username=self.username,
+                    password=self.password,
+                    data_dir=self.data_dir,
+                )
+            )
+        for account in self.accounts:
+            accounts.append(
+                dataclasses.replace(
+                    account,
+                    data_dir=(
+                        account.data_dir
+                        if account.data_dir is not None
+                        else os.path.join(self.data_dir, account.username)
+                    ),
+                )
+            )
+        for i, account in enumerate(accounts):
+            if account.web_vpn_mode is None:
+                account.web_vpn_mode = self.web_vpn_mode
+            if account.pushers is None:
+                account.pushers = self.pushers
+            if any(x.username == account.username for x in accounts[:i]):
+                raise ValueError(f"Duplicate account: {account.username}")
+        if len(accounts) == 0:
+            raise ValueError("No account configured")
+        return accounts
 
 
-def __update_data(global_config: GlobalConfig, pushers: list[Pusher]):
-    logging.info("Start fetching data")
-    session = requests.Session()
+def load_global_config(path: str, dry: bool = False) -> GlobalConfig:
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    global_config = dacite.from_dict(GlobalConfig, config)
+    if dry:
+        global_config.pushers = []
+        for account in global_config.accounts:
+            account.pushers = []
+    return global_config
+
+
+class _AccountLoggerAdapter(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        return f"[{self.extra['username']}] {msg}", kwargs  # type: ignore
+
+
+def __account_logger(account: AccountConfig) -> logging.LoggerAdapter:
+    return _AccountLoggerAdapter(logging.getLogger(), {"username": account.username})
+
+
+def __new_session(
+    global_config: GlobalConfig, retries: int | None = None
+) -> requests.Session:
+    session = TimeoutSession(global_config.timeouts, retries)
     session.headers.update(
         {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3",
         }
     )
-    web_vpn = NjuptWebVpn(session)
-    if global_config.web_vpn_mode == "auto" or global_config.web_vpn_mode is None:
-        use_web_vpn = web_vpn.auto_detect()
-    elif global_config.web_vpn_mode == "on" or global_config.web_vpn_mode is True:
-        use_web_vpn = True
-    elif global_config.web_vpn_mode == "off" or global_config.web_vpn_mode is False:
-        use_web_vpn = False
-    else:
-        logging.error(
+    mount_url_overrides(session, global_config.url_overrides)
+    return session
+
+
+def __forced_web_vpn_mode(
+    account: AccountConfig, logger: logging.LoggerAdapter
+) -> bool | None:
+    if account.web_vpn_mode == "on" or account.web_vpn_mode is True:
+        return True
+    if account.web_vpn_mode == "off" or account.web_vpn_mode is False:
+        return False
+    if account.web_vpn_mode != "auto" and account.web_vpn_mode is not None:
+        logger.error(
             "Invalid web vpn mode: %s, fallback to auto mode",
-            global_config.web_vpn_mode,
+            account.web_vpn_mode,
         )
-        use_web_vpn = web_vpn.auto_detect()
-    if use_web_vpn:
-        logging.info("Mode: Using WebVPN")
+    return None
+
+
+def __login(
+    account: AccountConfig,
+    sso: NjuptSso,
+    captcha_attempts: int,
+    logger: logging.LoggerAdapter,
+):
+    if sso.use_web_vpn:
+        logger.info("Mode: Using WebVPN")
     else:
-        logging.info("Mode: Direct")
-    sso = NjuptSso(session, use_web_vpn)
-    sso.login(global_config.username, global_config.password)
-    sso.grant_service("http://jwxt.njupt.edu.cn/login_cas.aspx")
-    eas = NjuptEduAdminSystem(session, global_config.username, use_web_vpn)
-    new_score = eas.get_score()
-    prev_score: list[CourseScoreInfo] = []
-    os.makedirs(global_config.data_dir, exist_ok=True)
-    if os.path.exists(os.path.join(global_config.data_dir, "score.json")):
-        with open(
-            os.path.join(global_config.data_dir, "score.json"),
-            "r",
-            encoding="utf-8",
-        ) as f:
-            prev_score = [CourseScoreInfo(**x) for x in json.load(f)]
-    with open(
-        os.path.join(global_config.data_dir, "score.json"), "w", encoding="utf-8"
-    ) as f:
-        json.dump(list(map(dataclasses.asdict, new_score)), f, ensure_ascii=False)
-
-    new_score_map = {x.id(): x for x in new_score}
-    prev_score_map = {x.id(): x for x in prev_score}
-    for course in new_score:
-        if course.id() not in prev_score_map:
-            logging.info("New item: %s %s", course.id(), course.course_name)
-            do_push(
-                MessageEntity(
-                    type=MessageType.NEW,
-                    content=course,
-                ),
-                pushers,
-            )
+        logger.info("Mode: Direct")
+    try:
+        with phase("sso_login"):
+            sso.login(account.username, account.password, captcha_attempts)
+        with phase("grant_service"):
+            sso.grant_service("http://jwxt.njupt.edu.cn/login_cas.aspx")
+    except Exception:
+        metrics.LOGIN_FAILURES.inc()
+        raise
+
+
+def __restore_eas_cache(eas: NjuptEduAdminSystem, cache: dict[str, Any]):
+    eas.name = cache.get("name")
+    try:
+        if cache.get("form_state") is not None:
+            eas.form_state = ScoreFormState(**cache["form_state"])
+    except TypeError:
+        eas.form_state = None
+
+
+def __eas_cache(eas: NjuptEduAdminSystem) -> dict[str, Any]:
+    return {
+        "name": eas.name,
+        "form_state": (
+            dataclasses.asdict(eas.form_state) if eas.form_state is not None else None
+        ),
+    }
+
+
+def __fetch_scores(
+    global_config: GlobalConfig,
+    account: AccountConfig,
+    session_store: SessionStore,
+    incremental: bool,
+    logger: logging.LoggerAdapter,
+) -> ScoreResult:
+    forced_web_vpn = __forced_web_vpn_mode(account, logger)
+    network_paths = get_network_paths()
+    session = __new_session(global_config)
+    use_web_vpn = session_store.load(session)
+    reuse_session = use_web_vpn is not None and forced_web_vpn in (None, use_web_vpn)
+    if not reuse_session:
+        session.cookies.clear()
+        if forced_web_vpn is not None:
+            use_web_vpn = forced_web_vpn
         else:
-            prev_course = prev_score_map[course.id()]
-            if course != prev_course:
-                logging.info("Item updated: %s %s", course.id(), course.course_name)
-                do_push(
-                    MessageEntity(
-                        type=MessageType.UPDATED,
-                        content=course,
-                        prev=prev_course,
-                    ),
-                    pushers,
+            # Probes have their own timeout and are not retried
+            use_web_vpn = network_paths.select(
+                lambda: __new_session(global_config, retries=0)
+            )
+    assert use_web_vpn is not None
+    sso = NjuptSso(
+        session, use_web_vpn, new_session=lambda: __new_session(global_config)
+    )
+    eas = NjuptEduAdminSystem(session, account.username, use_web_vpn)
+    __restore_eas_cache(eas, session_store.load_cache())
+    failed_over = False
+    while True:
+        try:
+            logged_in = False
+            if reuse_session:
+                reuse_session = False
+                with phase("session_check"):
+                    logged_in = eas.is_logged_in()
+                if logged_in:
+                    logger.info("Reusing saved session")
+                else:
+                    logger.info("Saved session expired")
+                    session.cookies.clear()
+            if not logged_in:
+                __login(account, sso, global_config.captcha_attempts, logger)
+                session_store.save(session, use_web_vpn, __eas_cache(eas))
+            with phase("get_score"):
+                result = eas.query_score(
+                    global_config.incremental.scope(),
+                    not incremental,
+                    global_config.score_extractor,
                 )
-    for prev_course in prev_score:
-        if prev_course.id() not in new_score_map:
-            logging.info(
-                "Item removed: %s %s", prev_course.id(), prev_course.course_name
+            session_store.save(session, use_web_vpn, __eas_cache(eas))
+            return result
+        except (requests.ConnectionError, requests.Timeout) as e:
+            # The path broke partway, log in again on the other one
+            if forced_web_vpn is not None or failed_over:
+                raise
+            fallback = network_paths.report_failure(use_web_vpn)
+            if fallback is None:
+                raise
+            _type = e.__class__.__name__
+            logger.warning(
+                "%s failed: (%s) %s, failing over to %s",
+                path_name(use_web_vpn),
+                _type,
+                e,
+                path_name(fallback),
             )
-            do_push(
-                MessageEntity(
-                    type=MessageType.REMOVED,
-                    content=prev_course,
+            failed_over = True
+            use_web_vpn = fallback
+            session.cookies.clear()
+            sso.switch_path(use_web_vpn)
+            eas.switch_path(use_web_vpn)
+
+
+def __outbox_path(account: AccountConfig) -> str:
+    assert account.data_dir is not None
+    return os.path.join(account.data_dir, "outbox.db")
+
+
+def __is_incremental(config: IncrementalConfig, store: ScoreStore) -> bool:
+    if not config.enabled:
+        return False
+    # The whole transcript is still reconciled from time to time, in case an
+    # older term is changed or the active term moves on
+    full_fetch_time = store.get_full_fetch_time()
+    return (
+        full_fetch_time is not None
+        and time.time() - full_fetch_time < config.full_interval
+    )
+
+
+# Returns the number of detected changes
+def __update_data(
+    global_config: GlobalConfig, account: AccountConfig, pushers: list[Pusher]
+) -> int:
+    assert account.data_dir is not None
+    logger = __account_logger(account)
+    logger.info("Start fetching data")
+    os.makedirs(account.data_dir, exist_ok=True)
+    session_store = SessionStore(os.path.join(account.data_dir, "session.json"))
+    store = open_score_store(global_config.storage, account.data_dir)
+    try:
+        with cycle_deadline(global_config.timeouts):
+            result = __fetch_scores(
+                global_config,
+                account,
+                session_store,
+                __is_incremental(global_config.incremental, store),
+                logger,
+            )
+        scope = result.scope
+        scope_key = scope.key() if scope is not None else ""
+        if scope is not None:
+            logger.info("Fetched term %s %s", scope.year, scope.term)
+        # Most polls return exactly the same transcript, skip everything below then
+        digest = result.digest
+        if store.get_digest(scope_key) == digest:
+            logger.info("No change (fingerprint matched)")
+            if scope is None:
+                # Still record the time of the full fetch
+                store.apply_changes([], digest)
+            metrics.LAST_SUCCESS.set(time.time(), account.username)
+            return 0
+        with phase("parse"):
+            new_score = result.get_courses()
+        with phase("diff"):
+            prev_score = store.load_snapshot()
+            changes = diff_scores(prev_score, new_score, scope)
+        if len(changes) != 0 and global_config.gpa_summary:
+            with phase("analytics"):
+                # numpy is only loaded once there is something to report
+                from njupt_score_pusher.analytics import attach_summaries
+
+                attach_summaries(prev_score, changes)
+        # Queue the notifications before committing the snapshot, so that a
+        # change is never recorded without being delivered eventually
+        with phase("store"):
+            if len(changes) != 0 and len(pushers) != 0:
+                outbox = Outbox(__outbox_path(account), global_config.outbox)
+                try:
+                    outbox.enqueue(
+                        [pusher_key(x) for x in pushers], changes, store.get_version()
+                    )
+                finally:
+                    outbox.close()
+            store.apply_changes(changes, digest, scope_key)
+    finally:
+        store.close()
+
+    for change in changes:
+        metrics.CHANGES.inc(change.type.name.lower())
+        course = change.content
+        if change.type == MessageType.NEW:
+            logger.info("New item: %s %s", course.id(), course.course_name)
+        elif change.type == MessageType.UPDATED:
+            logger.info("Item updated: %s %s", course.id(), course.course_name)
+        else:
+            logger.info("Item removed: %s %s", course.id(), course.course_name)
+    metrics.LAST_SUCCESS.set(time.time(), account.username)
+    logger.info("Data fetched")
+    return len(changes)
+
+
+def __update_data_noexcept(
+    global_config: GlobalConfig, account: AccountConfig, pushers: list[Pusher]
+) -> int | None:
+    try:
+        return __update_data(global_config, account, pushers)
+    except DeadlineExceeded as e:
+        __account_logger(account).error("Cycle cancelled: %s", e)
+        return None
+    except Exception as e:  # pylint: disable=broad-except
+        _type = e.__class__.__name__
+        __account_logger(account).error("Failed to fetch data: (%s) %s", _type, e)
+        return None
+
+
+def __create_executor(global_config: GlobalConfig) -> concurrent.futures.Executor:
+    if global_config.worker_mode == "process":
+        return concurrent.futures.ProcessPoolExecutor(global_config.max_workers)
+    if global_config.worker_mode != "thread":
+        logging.error(
+            "Invalid worker mode: %s, fallback to thread mode",
+            global_config.worker_mode,
+        )
+    return concurrent.futures.ThreadPoolExecutor(
+        global_config.max_workers, thread_name_prefix="scraper"
+    )
+
+
+def __run_oneshot(
+    global_config: GlobalConfig,
+    accounts: list[AccountConfig],
+    pushers: dict[str, list[Pusher]],
+):
+    if len(accounts) == 1:
+        __update_data(global_config, accounts[0], pushers[accounts[0].username])
+        return
+    first_error: Exception | None = None
+    with __create_executor(global_config) as executor:
+        futures = [
+            (
+                account,
+                executor.submit(
+                    __update_data, global_config, account, pushers[account.username]
                 ),
-                pushers,
             )
-    logging.info("Data fetched")
+            for account in accounts
+        ]
+        for account, future in futures:
+            try:
+                future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                if first_error is None:
+                    first_error = e
+                else:
+                    _type = e.__class__.__name__
+                    __account_logger(account).error(
+                        "Failed to fetch data: (%s) %s", _type, e
+                    )
+    if first_error is not None:
+        raise first_error
+
 
+def __run_profiled_cycle(
+    global_config: GlobalConfig,
+    accounts: list[AccountConfig],
+    pushers: dict[str, list[Pusher]],
+    outbox_sender: OutboxSender,
+):
+    # Everything runs in the calling thread, one account after another, so that
+    # the profile covers the whole cycle and the phases do not overlap
+    for account in accounts:
+        __update_data_noexcept(global_config, account, pushers[account.username])
+    outbox_sender.flush(global_config.outbox.flush_timeout, inline=True)
 
-def __update_data_noexcept(global_config: GlobalConfig, pushers: list[Pusher]):
+
+def __last_change_time(
+    global_config: GlobalConfig, account: AccountConfig
+) -> float | None:
+    # Read from the change log, so that a restart does not reset the backoff
+    # of a stable transcript
+    assert account.data_dir is not None
+    if not os.path.isdir(account.data_dir):
+        return None
     try:
-        __update_data(global_config, pushers)
+        store = open_score_store(global_config.storage, account.data_dir)
+        try:
+            return store.get_last_change_time()
+        finally:
+            store.close()
     except Exception as e:  # pylint: disable=broad-except
         _type = e.__class__.__name__
-        logging.error("Failed to fetch data: (%s) %s", _type, e)
+        __account_logger(account).error(
+            "Failed to read the last change time: (%s) %s", _type, e
+        )
+        return None
 
 
-def app_main(global_config: GlobalConfig, args):
-    pushers = build_pushers(global_config.pushers)
-    if args.oneshot:
-        __update_data(global_config, pushers)
-    else:
+# Settings only read at startup, the others are applied by a reload
+RESTART_REQUIRED_FIELDS = (
+    "max_workers",
+    "worker_mode",
+    "metrics",
+    "query_api",
+    "ocr",
+    "network",
+)
+
+
+@dataclasses.dataclass
+class _DaemonState:
+    global_config: GlobalConfig
+    accounts: dict[str, AccountConfig]
+    pushers: dict[str, list[Pusher]]
+    schedulers: dict[str, AdaptiveScheduler]
+    # The current due time of each account, entries of the schedule heap that
+    # do not match it are stale
+    due: dict[str, float]
+    # Serves the accounts and storage of the current configuration
+    query_api: QueryApi | None = None
+
+
+def __data_dirs(accounts: list[AccountConfig]) -> dict[str, str]:
+    data_dirs = {}
+    for account in accounts:
+        assert account.data_dir is not None
+        data_dirs[account.username] = account.data_dir
+    return data_dirs
+
+
+def __reload_pushers(
+    state: _DaemonState, accounts: list[AccountConfig]
+) -> dict[str, list[Pusher]]:
+    # Pushers are only rebuilt when their configuration changed, so that the
+    # others keep their connections; any invalid one rejects the reload
+    pushers = {}
+    for account in accounts:
+        prev = state.accounts.get(account.username)
+        if prev is not None and prev.pushers == account.pushers:
+            pushers[account.username] = state.pushers[account.username]
+            continue
+        params = account.pushers or []
+        pushers[account.username] = build_pushers(params)
+        if len(pushers[account.username]) != len(params):
+            raise ValueError(f"Invalid pushers of {account.username}")
+    return pushers
+
+
+def __reload_config(
+    state: _DaemonState,
+    path: str,
+    dry: bool,
+    outbox_sender: OutboxSender,
+    schedule: list[tuple[float, str]],
+):
+    try:
+        global_config = load_global_config(path, dry)
+        accounts = global_config.resolve_accounts()
+        pushers = __reload_pushers(state, accounts)
+    except Exception as e:  # pylint: disable=broad-except
+        _type = e.__class__.__name__
+        logging.error(
+            "Invalid configuration, keeping the previous one: (%s) %s", _type, e
+        )
+        return
+    for name in RESTART_REQUIRED_FIELDS:
+        if getattr(global_config, name) != getattr(state.global_config, name):
+            logging.warning("Changes to %s take effect after a restart", name)
+
+    rescheduled = (
+        global_config.scrape_interval != state.global_config.scrape_interval
+        or global_config.scheduler != state.global_config.scheduler
+    )
+    now = time.time()
+    start_time = now
+    for account in accounts:
+        logger = __account_logger(account)
+        scheduler = state.schedulers.get(account.username)
+        if scheduler is None:
+            logger.info("Account added")
+            state.schedulers[account.username] = AdaptiveScheduler(
+                global_config.scheduler,
+                global_config.scrape_interval,
+                now,
+                __last_change_time(global_config, account),
+            )
+            state.due[account.username] = start_time
+            heapq.heappush(schedule, (start_time, account.username))
+            start_time += global_config.start_stagger.random()
+        else:
+            # The history of the account is kept, and the current wait is cut
+            # short if the new interval is shorter
+            scheduler.config = global_config.scheduler
+            scheduler.normal_interval = global_config.scrape_interval
+            due = state.due.get(account.username)
+            if rescheduled and due is not None:
+                next_time = now + global_config.scrape_interval.random()
+                if next_time < due:
+                    state.due[account.username] = next_time
+                    heapq.heappush(schedule, (next_time, account.username))
+            if pushers[account.username] is not state.pushers[account.username]:
+                logger.info("Pushers reloaded")
+        outbox_sender.register(
+            account.username, __outbox_path(account), pushers[account.username]
+        )
+    usernames = {x.username for x in accounts}
+    for username in list(state.accounts):
+        if username not in usernames:
+            __account_logger(state.accounts[username]).info("Account removed")
+            outbox_sender.unregister(username)
+            state.schedulers.pop(username, None)
+            state.due.pop(username, None)
+    outbox_sender.reconfigure(global_config.outbox, global_config.push_batch)
+    if state.query_api is not None:
+        state.query_api.update(global_config.storage, __data_dirs(accounts))
+    state.global_config = global_config
+    state.accounts = {x.username: x for x in accounts}
+    state.pushers = pushers
+    logging.info("Configuration reloaded")
+
+
+def __run_daemon(
+    global_config: GlobalConfig,
+    accounts: list[AccountConfig],
+    pushers: dict[str, list[Pusher]],
+    outbox_sender: OutboxSender,
+    watcher: ConfigWatcher | None = None,
+    dry: bool = False,
+    query_api: QueryApi | None = None,
+):
+    # (due time, username), staggered so that logins do not burst
+    schedule: list[tuple[float, str]] = []
+    start_time = time.time()
+    state = _DaemonState(
+        global_config=global_config,
+        accounts={x.username: x for x in accounts},
+        pushers=pushers,
+        schedulers={
+            x.username: AdaptiveScheduler(
+                global_config.scheduler,
+                global_config.scrape_interval,
+                start_time,
+                __last_change_time(global_config, x),
+            )
+            for x in accounts
+        },
+        due={},
+        query_api=query_api,
+    )
+    for account in accounts:
+        state.due[account.username] = start_time
+        heapq.heappush(schedule, (start_time, account.username))
+        start_time += global_config.start_stagger.random()
+    running: dict[concurrent.futures.Future[int | None], str] = {}
+    with __create_executor(global_config) as executor:
         while True:
-            __update_data_noexcept(global_config, pushers)
-            interval = global_config.scrape_interval.random()
-            next_time = time.strftime(
-                "%Y-%m-%d %H:%M:%S", time.localtime(time.time() + interval)
+            if watcher is not None and watcher.poll():
+                __reload_config(state, watcher.path, dry, outbox_sender, schedule)
+            now = time.time()
+            while len(schedule) > 0 and schedule[0][0] <= now:
+                due, username = heapq.heappop(schedule)
+                # Removed, rescheduled by a reload, or still running
+                if state.due.get(username) != due or username in running.values():
+                    continue
+                future = executor.submit(
+                    __update_data_noexcept,
+                    state.global_config,
+                    state.accounts[username],
+                    state.pushers[username],
+                )
+                running[future] = username
+            timeout = schedule[0][0] - now if len(schedule) > 0 else None
+            if watcher is not None:
+                # Wakes up regularly to notice changes to the configuration
+                timeout = (
+                    CONFIG_CHECK_INTERVAL
+                    if timeout is None
+                    else min(timeout, CONFIG_CHECK_INTERVAL)
+                )
+            if len(running) == 0:
+                time.sleep(max(timeout or 0, 0))
+                continue
+            done, _ = concurrent.futures.wait(
+                running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            if len(done) != 0:
+                outbox_sender.wake()
+            for future in done:
+                username = running.pop(future)
+                account = state.accounts.get(username)
+                if account is None:
+                    continue
+                now = time.time()
+                interval, reason = state.schedulers[username].next_interval(
+                    future.result(), now
+                )
+                state.due[username] = now + interval
+                heapq.heappush(schedule, (now + interval, username))
+                next_time = time.strftime(
+                    "%Y-%m-%d %H:%M:%S", time.localtime(now + interval)
+                )
+                __account_logger(account).info(
+                    "Next update: %s (%s)", next_time, reason
+                )
+
+
+def app_main(global_config: GlobalConfig, args):
+    configure_shared_ocr(global_config.ocr)
+    configure_network_paths(global_config.network)
+    accounts = global_config.resolve_accounts()
+    pushers = {
+        account.username: build_pushers(account.pushers or []) for account in accounts
+    }
+    outbox_sender = OutboxSender(global_config.outbox, global_config.push_batch)
+    for account in accounts:
+        outbox_sender.register(
+            account.username, __outbox_path(account), pushers[account.username]
+        )
+    try:
+        profile_mode = getattr(args, "profile", None)
+        if profile_mode is not None:
+            # cProfile and tracemalloc are only loaded when profiling
+            from njupt_score_pusher.profiling import profile_cycle
+
+            if not args.oneshot:
+                logging.info("Profiling runs a single cycle")
+            profile_cycle(
+                profile_mode,
+                global_config.data_dir,
+                lambda: __run_profiled_cycle(
+                    global_config, accounts, pushers, outbox_sender
+                ),
+            )
+        elif args.oneshot:
+            try:
+                __run_oneshot(global_config, accounts, pushers)
+            finally:
+                outbox_sender.flush(global_config.outbox.flush_timeout)
+        else:
+            if global_config.metrics is not None:
+                start_metrics_server(global_config.metrics)
+            query_api = None
+            if global_config.query_api is not None:
+                query_api = QueryApi(global_config.storage, __data_dirs(accounts))
+                start_query_api(global_config.query_api, query_api)
+            outbox_sender.start()
+            watcher = None
+            config_path = getattr(args, "config", None)
+            if config_path is not None:
+                watcher = ConfigWatcher(config_path)
+                watcher.install_signal_handler()
+            __run_daemon(
+                global_config,
+                accounts,
+                pushers,
+                outbox_sender,
+                watcher,
+                getattr(args, "dry", False),
+                query_api,
             )
-            logging.info("Next update: %s", next_time)
-            time.sleep(interval)
+    finally:
+        # Waits for a delivery in progress, the queued messages are kept
+        outbox_sender.stop()
@@ -0,0 +1,47 @@
+import logging
+import os
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+# How often the daemon checks the configuration file for changes, in seconds
+CONFIG_CHECK_INTERVAL = 5.0
+
+
+class ConfigWatcher:
+    # Notices changes to the configuration file by polling its modification
+    # time and size, and reload requests sent by SIGHUP
+    def __init__(self, path: str):
+        self.path = path
+        self.__requested = threading.Event()
+        self.__signature = self.__stat()
+
+    def __stat(self) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def install_signal_handler(self):
+        # Not available on Windows, and only allowed in the main thread
+        if not hasattr(signal, "SIGHUP"):
+            return
+        if threading.current_thread() is not threading.main_thread():
+            return
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.request())
+
+    def request(self):
+        self.__requested.set()
+
+    def poll(self) -> bool:
+        # Returns whether the configuration should be reloaded; a broken file
+        # is only read again after it changes once more
+        signature = self.__stat()
+        changed = signature is not None and signature != self.__signature
+        self.__signature = signature
+        if self.__requested.is_set():
+            self.__requested.clear()
+            return True
+        return changed
@@ -0,0 +1,205 @@
+import bisect
+import dataclasses
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from njupt_score_pusher.phases import add_phase_observer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "njupt_score_pusher"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+@dataclasses.dataclass
+class MetricsConfig:
+    listen: str = "0.0.0.0"
+    port: int = 9108
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if len(names) == 0:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = f"{PREFIX}_{name}"
+        self.documentation = documentation
+        self.label_names = labels
+        self.lock = threading.Lock()
+
+    def expose(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self.lock:
+            lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+        if len(labels) == 0:
+            self.values[()] = 0
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(v)}"
+            for labels, v in self.values.items()
+        ]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, *labels: str):
+        with self.lock:
+            self.values[labels] = value
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(v)}"
+            for labels, v in self.values.items()
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Per label values: non-cumulative bucket counts, sum
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = ([0] * len(self.buckets), [0.0])
+            counts, total = self.values[labels]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = _format_labels(
+                    self.label_names + ("le",), labels + (_format_value(bound),)
+                )
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+PHASE_DURATION = Histogram(
+    "phase_duration_seconds", "Wall time of each scrape phase", ("phase",)
+)
+PHASE_FAILURES = Counter(
+    "phase_failures_total", "Scrape phases that raised an error", ("phase",)
+)
+LOGIN_FAILURES = Counter("login_failures_total", "Failed SSO logins")
+OCR_RETRIES = Counter("ocr_retries_total", "Captchas rejected by the SSO")
+CHANGES = Counter("changes_total", "Detected score changes", ("type",))
+PUSH_FAILURES = Counter("push_failures_total", "Failed pushes", ("pusher",))
+PUSH_THROTTLED = Counter(
+    "push_throttled_total", "Pushes rejected by a rate limit", ("pusher",)
+)
+LAST_SUCCESS = Gauge(
+    "last_successful_scrape_timestamp_seconds",
+    "Unix time of the last successful scrape",
+    ("account",),
+)
+ALL_METRICS: tuple[_Metric, ...] = (
+    PHASE_DURATION,
+    PHASE_FAILURES,
+    LOGIN_FAILURES,
+    OCR_RETRIES,
+    CHANGES,
+    PUSH_FAILURES,
+    PUSH_THROTTLED,
+    LAST_SUCCESS,
+)
+
+
+def _observe_phase(name: str, elapsed: float, error: BaseException | None):
+    PHASE_DURATION.observe(elapsed, name)
+    if error is not None:
+        PHASE_FAILURES.inc(name)
+
+
+add_phase_observer(_observe_phase)
+
+
+def expose_metrics() -> str:
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = expose_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def start_metrics_server(config: MetricsConfig) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((config.listen, config.port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    )
+    thread.start()
+    logger.info("Metrics endpoint: http://%s:%d/metrics", config.listen, config.port)
+    return server
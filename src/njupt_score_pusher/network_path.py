@@ -0,0 +1,133 @@
+import concurrent.futures
+import dataclasses
+import logging
+import threading
+import time
+from typing import Callable
+import requests
+from njupt_score_pusher.njupt_web_vpn import NjuptWebVpn
+from njupt_score_pusher.phases import phase
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class NetworkPathConfig:
+    # Seconds to reuse the selected path before probing again
+    cache_ttl: float = 60 * 60 * 6
+    # Seconds to wait for each probe
+    probe_timeout: float = 5
+    # Seconds a path is avoided after a request on it failed
+    failure_ttl: float = 60 * 30
+
+
+def path_name(use_web_vpn: bool) -> str:
+    return "WebVPN" if use_web_vpn else "Direct"
+
+
+class NoReachablePathError(Exception):
+    pass
+
+
+# Chooses between the direct campus network and the WebVPN for all accounts,
+# the choice is cached since it only depends on where the daemon runs
+class NetworkPathManager:
+    def __init__(self, config: NetworkPathConfig):
+        self.config = config
+        self.__lock = threading.Lock()
+        self.__selected: bool | None = None
+        self.__selected_until = 0.0
+        # use_web_vpn -> time until which the path is avoided
+        self.__failed_until: dict[bool, float] = {}
+
+    def select(self, new_session: Callable[[], requests.Session]) -> bool:
+        # Concurrent scrapes wait for a single probe instead of probing together
+        with self.__lock:
+            now = time.time()
+            if self.__selected is not None and now < self.__selected_until:
+                return self.__selected
+            with phase("webvpn_detect"):
+                use_web_vpn = self.__probe(new_session)
+            self.__selected = use_web_vpn
+            self.__selected_until = now + self.config.cache_ttl
+            return use_web_vpn
+
+    # Avoids the path for a while and returns the one to fail over to, or
+    # `None` if the other path has failed recently as well
+    def report_failure(self, use_web_vpn: bool) -> bool | None:
+        with self.__lock:
+            now = time.time()
+            self.__failed_until[use_web_vpn] = now + self.config.failure_ttl
+            if self.__failed_until.get(not use_web_vpn, 0) > now:
+                self.__selected = None
+                return None
+            self.__selected = not use_web_vpn
+            self.__selected_until = now + self.config.failure_ttl
+            return not use_web_vpn
+
+    def __probe(self, new_session: Callable[[], requests.Session]) -> bool:
+        # The probes run at the same time, each with its own session since a
+        # session is not thread-safe
+        direct_session = new_session()
+        web_vpn_session = new_session()
+        timeout = self.config.probe_timeout
+        try:
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                direct_future = executor.submit(
+                    NjuptWebVpn(direct_session).probe_direct, timeout
+                )
+                web_vpn_future = executor.submit(
+                    NjuptWebVpn(web_vpn_session).probe_web_vpn, timeout
+                )
+                latencies = {
+                    False: direct_future.result(),
+                    True: web_vpn_future.result(),
+                }
+        finally:
+            direct_session.close()
+            web_vpn_session.close()
+        logger.info(
+            "Network path latency: Direct %s, WebVPN %s",
+            NetworkPathManager.__format_latency(latencies[False]),
+            NetworkPathManager.__format_latency(latencies[True]),
+        )
+        now = time.time()
+        candidates = [
+            (latency, use_web_vpn)
+            for use_web_vpn, latency in latencies.items()
+            if latency is not None and self.__failed_until.get(use_web_vpn, 0) <= now
+        ]
+        if len(candidates) == 0:
+            # Recently failed paths are still better than nothing
+            candidates = [
+                (latency, use_web_vpn)
+                for use_web_vpn, latency in latencies.items()
+                if latency is not None
+            ]
+        if len(candidates) == 0:
+            raise NoReachablePathError("Neither Direct nor WebVPN is reachable")
+        return min(candidates)[1]
+
+    @staticmethod
+    def __format_latency(latency: float | None) -> str:
+        if latency is None:
+            return "unreachable"
+        return f"{latency * 1000:.0f}ms"
+
+
+__shared_manager_lock = threading.Lock()
+__shared_manager: NetworkPathManager | None = None
+
+
+def configure_network_paths(config: NetworkPathConfig):
+    global __shared_manager  # pylint: disable=global-statement
+    with __shared_manager_lock:
+        __shared_manager = NetworkPathManager(config)
+
+
+def get_network_paths() -> NetworkPathManager:
+    global __shared_manager  # pylint: disable=global-statement
+    with __shared_manager_lock:
+        if __shared_manager is None:
+            __shared_manager = NetworkPathManager(NetworkPathConfig())
+        return __shared_manager
@@ -1,10 +1,15 @@
 import base64
+import codecs
+import hashlib
 from dataclasses import dataclass
+import html
 from typing import Tuple
 import urllib.parse
 import logging
 import re
+import time
 import requests
+from njupt_score_pusher.phases import phase
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +21,99 @@ VIEW_STATE_PATTERN = re.compile(
 VIEW_STATE_GENERATOR_PATTERN = re.compile(
     r'<input type="hidden" name="__VIEWSTATEGENERATOR" value="(.+?)" />'
 )
+SELECT_PATTERN = re.compile(r'<select name="(\w+)"[^>]*>(.*?)</select>', re.DOTALL)
+OPTION_PATTERN = re.compile(r"<option([^>]*)>")
+OPTION_VALUE_PATTERN = re.compile(r'value="([^"]*)"')
+# Columns of the score grid in the order the EAS renders them, the view state
+# only holds the cells, so they are mapped by position there
+SCORE_GRID_HEADERS = (
+    "学年",
+    "学期",
+    "课程代码",
+    "课程名称",
+    "课程性质",
+    "课程归属",
+    "学分",
+    "绩点",
+    "平时成绩",
+    "期中成绩",
+    "期末成绩",
+    "实验成绩",
+    "卷面成绩",
+    "成绩",
+    "辅修标记",
+    "补考成绩",
+    "重修成绩",
+    "成绩作废标记",
+    "学院名称",
+    "备注",
+    "重修标记",
+    "课程英文名称",
+)
+# Without these, a row cannot be identified
+REQUIRED_SCORE_GRID_HEADERS = ("学年", "学期", "课程代码")
+VIEW_STATE_INPUT = 'name="__VIEWSTATE"'
+# Seconds a cached score form state is used before the page is loaded again,
+# so that the move to a new term is noticed
+FORM_STATE_TTL = 60 * 60 * 6
+GRID_START_PATTERN = re.compile(
+    r"<table\b[^>]*\bid=\"?Datagrid1\b[^>]*>", re.IGNORECASE
+)
+GRID_TAIL_SIZE = 1024
+ROW_PATTERN = re.compile(r"<tr\b[^>]*>(.*?)</tr>", re.DOTALL | re.IGNORECASE)
+CELL_PATTERN = re.compile(r"<t[dh]\b[^>]*>(.*?)</t[dh]>", re.DOTALL | re.IGNORECASE)
+TAG_PATTERN = re.compile(r"<[^>]*>")
+# Splits the payload into tokens and separators, an escape sequence (backslash
+# and the byte after it) is kept as a separator to be glued back into the token
+VIEW_STATE_SPLIT_PATTERN = re.compile(rb"(\\.?|[<>;])", re.DOTALL)
+
+
+def parse_view_state(view_state: str):
+    # The payload is UTF-8 followed by a 20-byte MAC. All separators are ASCII,
+    # so the payload can be split as bytes in one pass and each token decoded
+    # on its own, without building strings char by char.
+    data = base64.b64decode(view_state)[0:-20]
+    parts = VIEW_STATE_SPLIT_PATTERN.split(data)
+    values: list = []
+    stack: list[tuple[str, list]] = []
+    # Pieces of the current token when it contains escape sequences
+    pieces: list[bytes] = []
+    skip_semicolon = False
+    for i in range(1, len(parts), 2):
+        token = parts[i - 1]
+        separator = parts[i]
+        if skip_semicolon:
+            skip_semicolon = False
+            if separator == b";" and token == b"":
+                continue
+        if separator[0] == 0x5C:  # backslash
+            pieces.append(token)
+            pieces.append(separator[1:])
+            continue
+        if len(pieces) != 0:
+            pieces.append(token)
+            token = b"".join(pieces)
+            pieces.clear()
+        if separator == b"<":
+            stack.append((token.decode("utf-8"), values))
+            values = []
+        elif separator == b">":
+            values.append(token.decode("utf-8"))
+            if len(stack) == 0:
+                raise ValueError("Unbalanced view state")
+            key, parent = stack.pop()
+            parent.append({key: values})
+            values = parent
+            skip_semicolon = True
+        else:
+            values.append(token.decode("utf-8"))
+    if len(stack) != 0:
+        raise ValueError("Unbalanced view state")
+    pieces.append(parts[-1])
+    tail = b"".join(pieces).decode("utf-8")
+    if tail != "":
+        values.append(tail)
+    return values[0]
 
 
 @dataclass
@@ -57,23 +155,211 @@ class CourseScoreInfo:
         return f"{self.year}-{self.term}-{self.course_code}"
 
 
+def _course_from_columns(columns: dict[str, str]) -> CourseScoreInfo:
+    # Missing columns are left empty, so that a changed layout only loses
+    # the columns that are gone
+    def text(header: str) -> str:
+        return columns.get(header, "")
+
+    def number(header: str) -> float:
+        value = text(header)
+        return float(value) if value != "" else 0
+
+    def flag(header: str) -> bool:
+        value = text(header)
+        return value != "" and value != "0"
+
+    return CourseScoreInfo(
+        year=text("学年"),
+        term=text("学期"),
+        course_code=text("课程代码"),
+        course_name=text("课程名称"),
+        course_nature=text("课程性质"),
+        course_belong=text("课程归属"),
+        credit=number("学分"),
+        gpa=number("绩点"),
+        score=text("成绩"),
+        minor_flag=flag("辅修标记"),
+        makeup_score=text("补考成绩"),
+        retake_score=text("重修成绩"),
+        college_name=text("学院名称"),
+        comment=text("备注"),
+        retake_flag=flag("重修标记"),
+        course_english_name=text("课程英文名称"),
+    )
+
+
+# Extracts the courses from the score grid of a result page, columns are
+# mapped by their header. Feed the page as it arrives, only the unprocessed
+# tail is kept, and the rest of the page is skipped once the grid ends.
+class ScoreGridExtractor:
+    def __init__(self):
+        self.courses: list[CourseScoreInfo] = []
+        # Whether the page is a form result at all
+        self.has_view_state = False
+        self.done = False
+        self.__digest = hashlib.sha256()
+        self.__in_grid = False
+        self.__buffer = ""
+        self.__headers: list[str] | None = None
+
+    def feed(self, data: str) -> None:
+        if self.done:
+            return
+        buffer = self.__buffer + data
+        if not self.__in_grid:
+            if not self.has_view_state and VIEW_STATE_INPUT in buffer:
+                self.has_view_state = True
+            match = GRID_START_PATTERN.search(buffer)
+            if match is None:
+                # Keep enough for a tag split between two chunks
+                self.__buffer = buffer[-GRID_TAIL_SIZE:]
+                return
+            self.__in_grid = True
+            buffer = buffer[match.end() :]
+        end = buffer.find("</table>")
+        rows_end = end if end != -1 else len(buffer)
+        consumed = 0
+        for match in ROW_PATTERN.finditer(buffer, 0, rows_end):
+            self.__end_row(
+                [
+                    html.unescape(TAG_PATTERN.sub("", cell))
+                    .replace("\xa0", " ")
+                    .strip()
+                    for cell in CELL_PATTERN.findall(match.group(1))
+                ]
+            )
+            consumed = match.end()
+        if end != -1:
+            self.done = True
+            self.__buffer = ""
+        else:
+            self.__buffer = buffer[consumed:]
+
+    def close(self) -> None:
+        self.feed("")
+        # A form result without the grid means the layout changed, which must
+        # not be taken for an empty transcript
+        if self.has_view_state and self.__headers is None:
+            raise ValueError("Score grid not found")
+
+    # Digest of the cells, equal digests mean equal grids
+    def digest(self) -> str:
+        return self.__digest.hexdigest()
+
+    def __end_row(self, row: list[str]):
+        self.__digest.update("\x1f".join(row).encode("utf-8") + b"\x1e")
+        if self.__headers is None:
+            for header in REQUIRED_SCORE_GRID_HEADERS:
+                if header not in row:
+                    raise ValueError(f"Score grid lacks column {header}")
+            self.__headers = row
+            return
+        self.courses.append(_course_from_columns(dict(zip(self.__headers, row))))
+
+
+@dataclass(frozen=True)
+class TermScope:
+    # 学年, e.g. "2023-2024"
+    year: str
+    # 学期, e.g. "1", empty for the whole school year
+    term: str = ""
+
+    def key(self) -> str:
+        return f"{self.year}/{self.term}"
+
+    def contains(self, course: CourseScoreInfo) -> bool:
+        return course.year == self.year and self.term in ("", course.term)
+
+
+@dataclass
+class ScoreFormState:
+    # Hidden fields of the score page before any query
+    view_state: str
+    view_state_generator: str
+    # Term selected on the score page by default, empty if none
+    year: str
+    term: str
+    # time.time() when the page was loaded, 0 if unknown
+    loaded_at: float = 0.0
+
+    def is_expired(self, now: float) -> bool:
+        return not 0 <= now - self.loaded_at < FORM_STATE_TTL
+
+
+def _selected_options(page: str) -> dict[str, str]:
+    # Name of each <select> on the page -> value of its selected <option>
+    result = {}
+    for select_match in SELECT_PATTERN.finditer(page):
+        for option_match in OPTION_PATTERN.finditer(select_match.group(2)):
+            attributes = option_match.group(1)
+            value_match = OPTION_VALUE_PATTERN.search(attributes)
+            if "selected" in attributes and value_match is not None:
+                result[select_match.group(1)] = value_match.group(1)
+                break
+    return result
+
+
+@dataclass
+class ScoreResult:
+    # Queried term, `None` for the whole transcript
+    scope: TermScope | None
+    # Digest of the raw result, equal digests mean equal scores
+    digest: str
+    # Either the courses extracted from the HTML grid, or the view state to
+    # parse them from when needed
+    courses: Tuple[CourseScoreInfo, ...] | None = None
+    view_state: str | None = None
+
+    def get_courses(self) -> Tuple[CourseScoreInfo, ...]:
+        if self.courses is None:
+            assert self.view_state is not None
+            self.courses = NjuptEduAdminSystem.parse_score(self.view_state)
+        return self.courses
+
+
 class NjuptEduAdminSystem:
     def __init__(
         self,
         session: requests.Session,
         student_id: str,
         use_web_vpn: bool = False,
+        name: str | None = None,
+        form_state: ScoreFormState | None = None,
     ):
         self.session = session
+        self.switch_path(use_web_vpn)
+        self.student_id = student_id
+        # Neither changes between queries, so both are cached and can be
+        # restored from a previous run to save two requests per query; the
+        # form state expires after `FORM_STATE_TTL` since it holds the term
+        self.name = name
+        self.form_state = form_state
+
+    # Cookies are kept, but a login on one path is not valid on the other
+    def switch_path(self, use_web_vpn: bool) -> None:
         self.use_web_vpn = use_web_vpn
         self.base_url = (
             "http://jwxt.njupt.edu.cn"
             if not use_web_vpn
             else "https://vpn.njupt.edu.cn:8443/http/webvpn5e607416b84322620fcfebad55f2c381efb3e3d8de97685feb46fd2e866a8ae9"
         )
-        self.student_id = student_id
+
+    def is_logged_in(self) -> bool:
+        url = f"{self.base_url}/xs_main.aspx?xh={self.student_id}"
+        response = self.session.get(url, allow_redirects=False)
+        if response.status_code != 200:
+            return False
+        response.encoding = "gb18030"
+        match = NAME_PATTERN.search(response.text)
+        if match is None:
+            return False
+        self.name = match.group(1)
+        return True
 
     def get_name(self) -> str:
+        if self.name is not None:
+            return self.name
         url = f"{self.base_url}/xs_main.aspx?xh={self.student_id}"
         response = self.session.get(url)
         response.raise_for_status()
@@ -81,91 +367,172 @@ class NjuptEduAdminSystem:
         match = NAME_PATTERN.search(response.text)
         if match is None:
             raise ValueError("Failed to get name")
-        return match.group(1)
+        self.name = match.group(1)
+        return self.name
 
-    def __get_score_view_state(self) -> str:
+    def get_score_view_state(self) -> str:
+        result = self.query_score(None, True)
+        assert result.view_state is not None
+        return result.view_state
+
+    # Queries the whole transcript, or a single term (or school year if
+    # `scope.term` is empty), by default the one selected on the score page,
+    # which is the current term. The scope of the result is `None` if the
+    # whole transcript was queried because no term is selected on the page.
+    # The courses are read from the `extractor`, either "view_state" or the
+    # rendered "html" grid.
+    def query_score(
+        self,
+        scope: TermScope | None = None,
+        whole: bool = False,
+        extractor: str = "view_state",
+    ) -> ScoreResult:
+        if extractor not in ("view_state", "html"):
+            logger.error(
+                "Invalid score extractor: %s, fallback to view_state", extractor
+            )
+            extractor = "view_state"
+        with phase("eas_name"):
+            name = self.get_name()
         params = {
             "xh": self.student_id,
-            "xm": self.get_name(),
+            "xm": name,
             "gnmkdm": "N121605",
         }
         url = f"{self.base_url}/xscj_gc.aspx?" + urllib.parse.urlencode(
             params, encoding="gb18030"
         )
-        response = self.session.get(url)
+        if self.form_state is not None and self.form_state.is_expired(time.time()):
+            logger.debug("Cached form state expired, reloading the score page")
+            self.form_state = None
+        if self.form_state is not None:
+            try:
+                result = self.__post_score(
+                    url, self.form_state, scope, whole, extractor
+                )
+            except requests.HTTPError as e:
+                logger.debug("Query with the cached form state failed: %s", e)
+                result = None
+            if result is not None:
+                return result
+            logger.info("Cached form state rejected, reloading the score page")
+            self.form_state = None
+        with phase("eas_get"):
+            response = self.session.get(url)
         response.raise_for_status()
         response.encoding = "gb18030"
-        initial_view_state_match = VIEW_STATE_PATTERN.search(response.text)
-        initial_view_state_generator_match = VIEW_STATE_GENERATOR_PATTERN.search(
-            response.text
-        )
+        self.form_state = NjuptEduAdminSystem.__parse_form_state(response.text)
+        result = self.__post_score(url, self.form_state, scope, whole, extractor)
+        if result is None:
+            raise ValueError("Failed to get view state")
+        return result
+
+    @staticmethod
+    def __parse_form_state(page: str) -> ScoreFormState:
+        initial_view_state_match = VIEW_STATE_PATTERN.search(page)
+        initial_view_state_generator_match = VIEW_STATE_GENERATOR_PATTERN.search(page)
         if initial_view_state_match is None:
             raise ValueError("Failed to get initial view state")
-        view_state = initial_view_state_match.group(1)
-        view_state_generator = (
-            initial_view_state_generator_match.group(1)
-            if initial_view_state_generator_match is not None
-            else ""
+        selected = _selected_options(page)
+        return ScoreFormState(
+            view_state=initial_view_state_match.group(1),
+            view_state_generator=(
+                initial_view_state_generator_match.group(1)
+                if initial_view_state_generator_match is not None
+                else ""
+            ),
+            year=selected.get("ddlXN", ""),
+            term=selected.get("ddlXQ", ""),
+            loaded_at=time.time(),
         )
+
+    # Returns `None` if the server did not accept the form state
+    def __post_score(
+        self,
+        url: str,
+        form_state: ScoreFormState,
+        scope: TermScope | None,
+        whole: bool,
+        extractor: str,
+    ) -> ScoreResult | None:
+        if not whole and scope is None:
+            if form_state.year == "":
+                logger.warning("No active term on the score page, query all terms")
+                whole = True
+            else:
+                scope = TermScope(form_state.year, form_state.term)
+        if whole or scope is None:
+            scope = None
+            year, term = "", ""
+            button = {"Button2": "在校学习成绩查询"}
+        elif scope.term == "":
+            year, term = scope.year, ""
+            button = {"Button5": "按学年查询"}
+        else:
+            year, term = scope.year, scope.term
+            button = {"Button1": "按学期查询"}
         data = {
-            "__VIEWSTATE": view_state,
-            "__VIEWSTATEGENERATOR": view_state_generator,
-            "ddlXN": "",
-            "ddlXQ": "",
-            "Button2": "在校学习成绩查询",
+            "__VIEWSTATE": form_state.view_state,
+            "__VIEWSTATEGENERATOR": form_state.view_state_generator,
+            "ddlXN": year,
+            "ddlXQ": term,
+            **button,
         }
-        response = self.session.post(
-            url,
-            data=urllib.parse.urlencode(data, encoding="gb18030"),
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-        )
+        if extractor == "html":
+            return self.__post_score_html(url, data, scope)
+        with phase("eas_post"):
+            response = self.session.post(
+                url,
+                data=urllib.parse.urlencode(data, encoding="gb18030"),
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+            )
         response.raise_for_status()
         response.encoding = "gb18030"
         view_state_match = VIEW_STATE_PATTERN.search(response.text)
         if view_state_match is None:
-            raise ValueError("Failed to get view state")
+            return None
         view_state = view_state_match.group(1)
-        return view_state
+        return ScoreResult(
+            scope=scope,
+            digest=hashlib.sha256(view_state.encode("utf-8")).hexdigest(),
+            view_state=view_state,
+        )
+
+    def __post_score_html(
+        self, url: str, data: dict[str, str], scope: TermScope | None
+    ) -> ScoreResult | None:
+        # The grid is extracted while the page is downloaded
+        extractor = ScoreGridExtractor()
+        decoder = codecs.getincrementaldecoder("gb18030")(errors="replace")
+        with phase("eas_post"):
+            response = self.session.post(
+                url,
+                data=urllib.parse.urlencode(data, encoding="gb18030"),
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                stream=True,
+            )
+            try:
+                response.raise_for_status()
+                for chunk in response.iter_content(64 * 1024):
+                    extractor.feed(decoder.decode(chunk))
+                extractor.feed(decoder.decode(b"", final=True))
+                extractor.close()
+            finally:
+                response.close()
+        if not extractor.has_view_state:
+            return None
+        return ScoreResult(
+            scope=scope,
+            digest=extractor.digest(),
+            courses=tuple(extractor.courses),
+        )
+
+    def get_score(self) -> Tuple[CourseScoreInfo, ...]:
+        return NjuptEduAdminSystem.parse_score(self.get_score_view_state())
 
     @staticmethod
-    def __parse_view_state(view_state: str):
-        tag_string = base64.b64decode(view_state)[0:-20].decode("utf-8")
-        tag = ""
-        values = []
-        stack = []
-        is_escaped = False
-        skip_next_semicolon = False
-        for char in tag_string:
-            if skip_next_semicolon:
-                skip_next_semicolon = False
-                if char == ";":
-                    continue
-            if is_escaped:
-                tag += char
-                is_escaped = False
-            elif char == "\\":
-                is_escaped = True
-            elif char == "<":
-                stack.append((tag, len(values)))
-                tag = ""
-            elif char == ">":
-                values.append(tag)
-                tag = ""
-                prev_tag, prev_length = stack.pop()
-                values = values[:prev_length] + [{prev_tag: values[prev_length:]}]
-                skip_next_semicolon = True
-            elif char == ";":
-                values.append(tag)
-                tag = ""
-            else:
-                tag += char
-        if tag != "":
-            values.append(tag)
-        return values[0]
-
-    def get_score(self) -> Tuple[CourseScoreInfo]:
-        state_str = self.__get_score_view_state()
-        state = NjuptEduAdminSystem.__parse_view_state(state_str)
+    def parse_score(view_state: str) -> Tuple[CourseScoreInfo, ...]:
+        state = parse_view_state(view_state)
         courses = state["t"][1]["t"][2]["l"][0]["t"][2]["l"][13]["t"][2]["l"][0]["t"][
             2
         ]["l"]
@@ -173,31 +540,10 @@ class NjuptEduAdminSystem:
         for course in courses:
             if not isinstance(course, dict):
                 continue
-            texts = tuple(
-                (
-                    x["t"][0]["p"][0]["p"][1]["l"][0].replace("&nbsp;", " ").strip()
-                    for x in course["t"][2]["l"]
-                    if isinstance(x, dict)
-                )
-            )
-            result.append(
-                CourseScoreInfo(
-                    year=texts[0],
-                    term=texts[1],
-                    course_code=texts[2],
-                    course_name=texts[3],
-                    course_nature=texts[4],
-                    course_belong=texts[5],
-                    credit=float(texts[6]) if texts[6] != "" else 0,
-                    gpa=float(texts[7]) if texts[7] != "" else 0,
-                    score=texts[13],
-                    minor_flag=texts[14] != "" and texts[14] != "0",
-                    makeup_score=texts[15],
-                    retake_score=texts[16],
-                    college_name=texts[18],
-                    comment=texts[19],
-                    retake_flag=texts[20] != "" and texts[20] != "0",
-                    course_english_name=texts[21],
-                )
+            texts = (
+                x["t"][0]["p"][0]["p"][1]["l"][0].replace("&nbsp;", " ").strip()
+                for x in course["t"][2]["l"]
+                if isinstance(x, dict)
             )
+            result.append(_course_from_columns(dict(zip(SCORE_GRID_HEADERS, texts))))
         return tuple(result)
@@ -1,25 +1,49 @@
 import base64
+import concurrent.futures
 import datetime
 import logging
+from typing import Callable
 import urllib.parse
 import requests
-import ddddocr
-from Crypto.Cipher import AES
-from Crypto.Util import Padding
+from njupt_score_pusher import metrics
+from njupt_score_pusher.ocr import OcrService, get_shared_ocr
+from njupt_score_pusher.phases import phase
+from njupt_score_pusher.timeouts import (
+    TimeoutConfig,
+    current_deadline,
+    inherited_deadline,
+)
 
 logger = logging.getLogger(__name__)
 
+# Part of the message returned by the SSO when the captcha is wrong
+CAPTCHA_ERROR_KEYWORD = "验证码"
+
 
 class NjuptSsoException(Exception):
     def __init__(self, code: int, message: str):
+        super().__init__(code, message)
         self.code = code
         self.message = message
 
 
 class NjuptSso:
-    def __init__(self, session: requests.Session, use_web_vpn: bool = False):
+    def __init__(
+        self,
+        session: requests.Session,
+        use_web_vpn: bool = False,
+        ocr: OcrService | None = None,
+        new_session: Callable[[], requests.Session] | None = None,
+    ):
         self.session = session
-        self.ocr = ddddocr.DdddOcr(show_ad=False)
+        # Creates the session the captcha is prefetched on, without it the
+        # captcha is only fetched once it is known to be required
+        self.new_session = new_session
+        self.ocr = ocr if ocr is not None else get_shared_ocr()
+        self.switch_path(use_web_vpn)
+
+    # Cookies are kept, but a login on one path is not valid on the other
+    def switch_path(self, use_web_vpn: bool) -> None:
         self.use_web_vpn = use_web_vpn
         self.base_url = (
             "https://i.njupt.edu.cn"
@@ -27,23 +51,79 @@ class NjuptSso:
             else "https://vpn.njupt.edu.cn:8443/http/webvpn136ccf6a01ae6ad865c858647c2c1787df24ddb65ef7dc25fd3739a96a22c0ea"
         )
 
-    def login(self, username: str, password: str) -> None:
-        skipCaptcha = self.__if_skip_captcha(username)
-        checkKey = str(int(datetime.datetime.now().timestamp() * 1000))
-        captcha = ""
-        if not skipCaptcha:
-            captcha_image = self.__get_captcha_image(checkKey)
-            captcha = self.ocr.classification(captcha_image)
-            logger.debug("Captcha recognized as %s for key %s", captcha, checkKey)
-        else:
+    def login(self, username: str, password: str, max_attempts: int = 3) -> None:
+        check_key = NjuptSso.__new_check_key()
+        # Prefetch the captcha while asking whether it is required at all. A
+        # session is not thread-safe, so the prefetch runs on its own with a
+        # copy of the cookies, under the deadline of the calling thread.
+        captcha_session = self.new_session() if self.new_session else None
+        captcha_future = None
+        sent_cookies = {}
+        if captcha_session is not None:
+            captcha_session.cookies.update(self.session.cookies)
+            sent_cookies = NjuptSso.__cookie_values(captcha_session)
+            executor = concurrent.futures.ThreadPoolExecutor(
+                1, thread_name_prefix="captcha"
+            )
+            captcha_future = executor.submit(
+                self.__prefetch_captcha, captcha_session, check_key, current_deadline()
+            )
+            executor.shutdown(wait=False)
+        if self.__if_skip_captcha(username):
             logger.debug("Captcha skipped")
+            self.__submit_login(username, password, "", check_key)
+            return
 
+        max_attempts = max(max_attempts, 1)
+        for attempt in range(1, max_attempts + 1):
+            if attempt == 1 and captcha_future is not None:
+                assert captcha_session is not None
+                captcha_image = captcha_future.result()
+                # Only the cookies the captcha request set or changed
+                for cookie in captcha_session.cookies:
+                    key = (cookie.domain, cookie.path, cookie.name)
+                    if sent_cookies.get(key) != cookie.value:
+                        self.session.cookies.set_cookie(cookie)
+            else:
+                if attempt != 1:
+                    check_key = NjuptSso.__new_check_key()
+                captcha_image = self.__get_captcha_image(self.session, check_key)
+            with phase("ocr"):
+                captcha = self.ocr.classification(captcha_image)
+            logger.debug("Captcha recognized as %s for key %s", captcha, check_key)
+            try:
+                self.__submit_login(username, password, captcha, check_key)
+            except NjuptSsoException as e:
+                if not NjuptSso.__is_captcha_error(e):
+                    raise
+                self.ocr.record_result(False)
+                metrics.OCR_RETRIES.inc()
+                logger.info(
+                    "Captcha rejected (attempt %d/%d): %s",
+                    attempt,
+                    max_attempts,
+                    e.message,
+                )
+                if attempt == max_attempts:
+                    raise
+                continue
+            self.ocr.record_result(True)
+            logger.info(
+                "Captcha accepted on attempt %d, OCR success rate: %s",
+                attempt,
+                self.ocr.success_rate_text(),
+            )
+            return
+
+    def __submit_login(
+        self, username: str, password: str, captcha: str, check_key: str
+    ) -> None:
         url = f"{self.base_url}/ssoLogin/login"
         data = {
-            "username": NjuptSso._encrypt(username, checkKey),
-            "password": NjuptSso._encrypt(password, checkKey),
+            "username": NjuptSso._encrypt(username, check_key),
+            "password": NjuptSso._encrypt(password, check_key),
             "captcha": captcha,
-            "checkKey": checkKey,
+            "checkKey": check_key,
         }
 
         response = self.session.post(url, data=data).json()
@@ -55,6 +135,14 @@ class NjuptSso:
                 "https://vpn.njupt.edu.cn:8443/enlink/api/client/callback/cas"
             )
 
+    @staticmethod
+    def __new_check_key() -> str:
+        return str(int(datetime.datetime.now().timestamp() * 1000))
+
+    @staticmethod
+    def __is_captcha_error(e: NjuptSsoException) -> bool:
+        return CAPTCHA_ERROR_KEYWORD in str(e.message)
+
     def grant_service(self, service: str) -> None:
         url = f"{self.base_url}/cas/login?service={urllib.parse.quote(service)}"
         response = self.session.get(url)
@@ -65,6 +153,10 @@ class NjuptSso:
 
     @staticmethod
     def _encrypt(data: str, key: str) -> str:
+        # Only needed for a fresh login, keep it out of the startup path
+        from Crypto.Cipher import AES
+        from Crypto.Util import Padding
+
         cipher_key = b"iam" + key.encode()
         cipher_iv = cipher_key
         cipher = AES.new(cipher_key, AES.MODE_CBC, cipher_iv)
@@ -77,9 +169,26 @@ class NjuptSso:
         response = self.session.get(url).json()
         return response["success"]
 
-    def __get_captcha_image(self, check_key: str) -> bytes:
+    @staticmethod
+    def __cookie_values(session: requests.Session) -> dict[tuple, str | None]:
+        return {(x.domain, x.path, x.name): x.value for x in session.cookies}
+
+    def __prefetch_captcha(
+        self,
+        session: requests.Session,
+        check_key: str,
+        deadline: tuple[TimeoutConfig, float] | None,
+    ) -> bytes:
+        try:
+            with inherited_deadline(deadline):
+                return self.__get_captcha_image(session, check_key)
+        finally:
+            session.close()
+
+    def __get_captcha_image(self, session: requests.Session, check_key: str) -> bytes:
         url = f"{self.base_url}/sys/randomImage/{check_key}"
-        response = self.session.get(url).json()
+        with phase("captcha"):
+            response = session.get(url).json()
         if not response["success"]:
             raise NjuptSsoException(response["code"], response["message"])
         data_uri = response["result"]
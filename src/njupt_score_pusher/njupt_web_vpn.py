@@ -1,15 +1,44 @@
+import time
 import requests
 
+DIRECT_PROBE_URL = "https://i.njupt.edu.cn/"
+WEB_VPN_PROBE_URL = "https://vpn.njupt.edu.cn:8443/"
+
 
 class NjuptWebVpn:
     def __init__(self, session: requests.Session):
         self.session = session
 
-    def auto_detect(self) -> bool:
-        url = "https://i.njupt.edu.cn/"
-        response = self.session.get(url, allow_redirects=False)
+    def auto_detect(self, timeout: float | None = None) -> bool:
+        response = self.session.get(
+            DIRECT_PROBE_URL, allow_redirects=False, timeout=timeout
+        )
         response.raise_for_status()
         if response.status_code == 302:
             if "webvpn" in response.headers["Location"]:
                 return True
         return False
+
+    # Returns the round-trip time in seconds, or `None` if the campus network
+    # is not directly reachable (off campus, the SSO redirects to the WebVPN)
+    def probe_direct(self, timeout: float) -> float | None:
+        start = time.perf_counter()
+        try:
+            if self.auto_detect(timeout):
+                return None
+        except requests.RequestException:
+            return None
+        return time.perf_counter() - start
+
+    # Returns the round-trip time in seconds, or `None` if the WebVPN is down
+    def probe_web_vpn(self, timeout: float) -> float | None:
+        start = time.perf_counter()
+        try:
+            response = self.session.get(
+                WEB_VPN_PROBE_URL, allow_redirects=False, timeout=timeout
+            )
+        except requests.RequestException:
+            return None
+        if response.status_code >= 400:
+            return None
+        return time.perf_counter() - start
@@ -0,0 +1,250 @@
+import dataclasses
+import gc
+import logging
+import os
+import threading
+import time
+from typing import Any
+from njupt_score_pusher.timeouts import check_deadline, remaining_budget
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for the helper process to load the model
+WORKER_START_TIMEOUT = 120
+
+
+@dataclasses.dataclass
+class OcrConfig:
+    # "inprocess" keeps the model in the daemon, "subprocess" in a helper process
+    mode: str = "inprocess"
+    # Seconds without recognition before the model is unloaded, <= 0 to keep it
+    idle_timeout: float = 300
+    # Seconds to wait for the helper process to recognize a captcha, also
+    # limited by the cycle deadline; a worker that takes longer is restarted
+    recognition_timeout: float = 30
+
+
+def _current_rss() -> int | None:
+    try:
+        with open("/proc/self/statm", "r", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _format_rss(rss: int | None) -> str:
+    if rss is None:
+        return "unknown"
+    return f"{rss / 1024 / 1024:.1f} MiB"
+
+
+def _load_model() -> Any:
+    import ddddocr
+
+    return ddddocr.DdddOcr(show_ad=False)
+
+
+def _worker_main(conn: Any):
+    start = time.perf_counter()
+    model = _load_model()
+    conn.send(("ready", time.perf_counter() - start, _current_rss()))
+    while True:
+        try:
+            image = conn.recv()
+        except EOFError:
+            break
+        if image is None:
+            break
+        try:
+            conn.send(("ok", model.classification(image)))
+        except Exception as e:  # pylint: disable=broad-except
+            conn.send(("error", f"({e.__class__.__name__}) {e}"))
+    conn.close()
+
+
+class OcrService:
+    def __init__(self, config: OcrConfig):
+        self.config = config
+        self.lock = threading.Lock()
+        self.idle_timer: threading.Timer | None = None
+        # In-process model
+        self.model: Any = None
+        # Subprocess worker
+        self.process: Any = None
+        self.conn: Any = None
+        # Captchas accepted / submitted by the SSO
+        self.stats_lock = threading.Lock()
+        self.accepted_count = 0
+        self.submitted_count = 0
+
+    def classification(self, image: bytes) -> str:
+        with self.lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+            try:
+                if self.config.mode == "subprocess":
+                    return self.__classify_in_subprocess(image)
+                if self.config.mode != "inprocess":
+                    logger.error(
+                        "Invalid OCR mode: %s, fallback to inprocess mode",
+                        self.config.mode,
+                    )
+                return self.__classify_in_process(image)
+            finally:
+                if self.config.idle_timeout > 0:
+                    self.idle_timer = threading.Timer(
+                        self.config.idle_timeout, self.__unload_when_idle
+                    )
+                    self.idle_timer.daemon = True
+                    self.idle_timer.start()
+
+    def record_result(self, accepted: bool):
+        with self.stats_lock:
+            self.submitted_count += 1
+            if accepted:
+                self.accepted_count += 1
+
+    def success_rate_text(self) -> str:
+        with self.stats_lock:
+            if self.submitted_count == 0:
+                return "n/a"
+            return "{:.1f}% ({}/{})".format(
+                self.accepted_count / self.submitted_count * 100,
+                self.accepted_count,
+                self.submitted_count,
+            )
+
+    def close(self):
+        with self.lock:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+            self.__unload()
+
+    def __classify_in_process(self, image: bytes) -> str:
+        if self.model is None:
+            rss_before = _current_rss()
+            start = time.perf_counter()
+            self.model = _load_model()
+            logger.info(
+                "OCR model loaded in %.2fs, RSS %s -> %s",
+                time.perf_counter() - start,
+                _format_rss(rss_before),
+                _format_rss(_current_rss()),
+            )
+        return self.model.classification(image)
+
+    def __classify_in_subprocess(self, image: bytes) -> str:
+        if self.process is None or not self.process.is_alive():
+            self.__start_worker()
+        assert self.conn is not None
+        timeout = self.config.recognition_timeout
+        budget = remaining_budget()
+        if budget is not None:
+            timeout = min(timeout, max(budget[0], 0))
+        try:
+            self.conn.send(image)
+            if not self.conn.poll(timeout):
+                # Hung, the next recognition starts a new worker
+                logger.error("OCR worker did not answer in %.1fs, terminating", timeout)
+                self.__terminate_worker()
+                check_deadline()
+                raise RuntimeError("OCR worker timed out")
+            status, result = self.conn.recv()
+        except (EOFError, OSError) as e:
+            self.__unload()
+            raise RuntimeError("OCR worker exited unexpectedly") from e
+        if status != "ok":
+            raise RuntimeError(f"OCR worker failed: {result}")
+        return result
+
+    def __start_worker(self):
+        import multiprocessing
+
+        self.__unload()
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(
+            target=_worker_main, args=(child_conn,), name="ocr-worker", daemon=True
+        )
+        process.start()
+        child_conn.close()
+        try:
+            if not parent_conn.poll(WORKER_START_TIMEOUT):
+                raise EOFError("timed out")
+            _, load_time, worker_rss = parent_conn.recv()
+        except EOFError as e:
+            parent_conn.close()
+            process.terminate()
+            process.join()
+            raise RuntimeError("OCR worker failed to start") from e
+        self.process = process
+        self.conn = parent_conn
+        logger.info(
+            "OCR worker %d started, model loaded in %.2fs, worker RSS %s, daemon RSS %s",
+            process.pid,
+            load_time,
+            _format_rss(worker_rss),
+            _format_rss(_current_rss()),
+        )
+
+    def __unload_when_idle(self):
+        with self.lock:
+            # Superseded by a recognition that finished while we were waiting
+            if self.idle_timer is not threading.current_thread():
+                return
+            self.idle_timer = None
+            self.__unload()
+            logger.info(
+                "OCR model unloaded after %.0fs idle, RSS %s",
+                self.config.idle_timeout,
+                _format_rss(_current_rss()),
+            )
+
+    def __terminate_worker(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __unload(self):
+        if self.model is not None:
+            self.model = None
+            gc.collect()
+        if self.process is not None:
+            if self.conn is not None:
+                try:
+                    self.conn.send(None)
+                except OSError:
+                    pass
+                self.conn.close()
+                self.conn = None
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+            self.process = None
+
+
+__shared_service_lock = threading.Lock()
+__shared_service: OcrService | None = None
+
+
+def configure_shared_ocr(config: OcrConfig):
+    global __shared_service  # pylint: disable=global-statement
+    with __shared_service_lock:
+        if __shared_service is not None:
+            __shared_service.close()
+        __shared_service = OcrService(config)
+
+
+def get_shared_ocr() -> OcrService:
+    global __shared_service  # pylint: disable=global-statement
+    with __shared_service_lock:
+        if __shared_service is None:
+            __shared_service = OcrService(OcrConfig())
+        return __shared_service
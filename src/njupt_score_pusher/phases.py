@@ -0,0 +1,149 @@
+import contextlib
+import dataclasses
+import logging
+import sys
+import threading
+import time
+from typing import Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Called with the phase name, its wall time in seconds and the error it raised
+PhaseObserver = Callable[[str, float, BaseException | None], None]
+
+
+@dataclasses.dataclass
+class PhaseSpan:
+    name: str
+    # time.perf_counter() at start
+    start: float
+    elapsed: float = 0.0
+    error: BaseException | None = None
+    # Names of the enclosing phases, outermost first
+    parents: tuple[str, ...] = ()
+    thread: str = ""
+    # HTTP requests sent within the phase, including its inner phases
+    requests: int = 0
+    sent_bytes: int = 0
+    received_bytes: int = 0
+    # Peak of the memory traced by tracemalloc within the phase, None when it
+    # is not tracing
+    memory_peak: int | None = None
+
+
+# Called with every finished phase, in the thread that ran it
+SpanObserver = Callable[[PhaseSpan], None]
+
+__observers_lock = threading.Lock()
+__observers: list[PhaseObserver] = []
+__span_observers: list[SpanObserver] = []
+# Phases running in the current thread, outermost first
+__local = threading.local()
+
+
+def add_phase_observer(observer: PhaseObserver):
+    with __observers_lock:
+        __observers.append(observer)
+
+
+def remove_phase_observer(observer: PhaseObserver):
+    with __observers_lock:
+        if observer in __observers:
+            __observers.remove(observer)
+
+
+def add_span_observer(observer: SpanObserver):
+    with __observers_lock:
+        __span_observers.append(observer)
+
+
+def remove_span_observer(observer: SpanObserver):
+    with __observers_lock:
+        if observer in __span_observers:
+            __span_observers.remove(observer)
+
+
+def __stack() -> list[PhaseSpan]:
+    if not hasattr(__local, "stack"):
+        __local.stack = []
+    return __local.stack
+
+
+# Returns (name, perf_counter() at start) of the phases running in the current
+# thread, outermost first
+def active_phases() -> list[tuple[str, float]]:
+    return [(x.name, x.start) for x in __stack()]
+
+
+def record_transfer(requests: int = 0, sent: int = 0, received: int = 0):
+    # Counted towards every phase running in the current thread
+    for span in __stack():
+        span.requests += requests
+        span.sent_bytes += sent
+        span.received_bytes += received
+
+
+def __tracemalloc():
+    # Only when loaded by a profiler, so that it is never imported here
+    tracemalloc = sys.modules.get("tracemalloc")
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    return tracemalloc
+
+
+def __enter_memory(tracemalloc, stack: list[PhaseSpan], span: PhaseSpan):
+    # tracemalloc keeps a single peak, so it is folded into the enclosing phase
+    # before being reset for the new one
+    peak = tracemalloc.get_traced_memory()[1]
+    if len(stack) != 0 and stack[-1].memory_peak is not None:
+        stack[-1].memory_peak = max(stack[-1].memory_peak, peak)
+    tracemalloc.reset_peak()
+    span.memory_peak = 0
+
+
+def __exit_memory(tracemalloc, stack: list[PhaseSpan], span: PhaseSpan):
+    assert span.memory_peak is not None
+    span.memory_peak = max(span.memory_peak, tracemalloc.get_traced_memory()[1])
+    if len(stack) != 0 and stack[-1].memory_peak is not None:
+        stack[-1].memory_peak = max(stack[-1].memory_peak, span.memory_peak)
+    tracemalloc.reset_peak()
+
+
+@contextlib.contextmanager
+def phase(name: str) -> Iterator[None]:
+    stack = __stack()
+    span = PhaseSpan(
+        name,
+        time.perf_counter(),
+        parents=tuple(x.name for x in stack),
+        thread=threading.current_thread().name,
+    )
+    tracemalloc = __tracemalloc()
+    if tracemalloc is not None:
+        __enter_memory(tracemalloc, stack, span)
+    stack.append(span)
+    try:
+        yield
+    except BaseException as e:
+        span.error = e
+        raise
+    finally:
+        stack.pop()
+        span.elapsed = time.perf_counter() - span.start
+        if tracemalloc is not None and span.memory_peak is not None:
+            __exit_memory(tracemalloc, stack, span)
+        with __observers_lock:
+            observers = list(__observers)
+            span_observers = list(__span_observers)
+        for observer in observers:
+            try:
+                observer(name, span.elapsed, span.error)
+            except Exception as e:  # pylint: disable=broad-except
+                _type = e.__class__.__name__
+                logger.error("Phase observer failed: (%s) %s", _type, e)
+        for span_observer in span_observers:
+            try:
+                span_observer(span)
+            except Exception as e:  # pylint: disable=broad-except
+                _type = e.__class__.__name__
+                logger.error("Span observer failed: (%s) %s", _type, e)
@@ -0,0 +1,157 @@
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable
+from njupt_score_pusher.phases import (
+    PhaseSpan,
+    add_span_observer,
+    phase,
+    remove_span_observer,
+)
+
+logger = logging.getLogger(__name__)
+
+# "cpu" runs the cycle under cProfile, "memory" under tracemalloc
+PROFILE_MODES = ("cpu", "memory")
+# Frames kept for each traced allocation
+TRACEBACK_DEPTH = 8
+TOP_ALLOCATIONS = 20
+
+
+class SpanRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans: list[PhaseSpan] = []
+
+    def __call__(self, span: PhaseSpan):
+        with self.lock:
+            self.spans.append(span)
+
+
+def __span_to_dict(span: PhaseSpan, origin: float) -> dict[str, Any]:
+    return {
+        "name": span.name,
+        "parents": list(span.parents),
+        "thread": span.thread,
+        # Seconds since the start of the cycle
+        "start": round(span.start - origin, 6),
+        "wall_time": round(span.elapsed, 6),
+        "requests": span.requests,
+        "sent_bytes": span.sent_bytes,
+        "received_bytes": span.received_bytes,
+        "memory_peak": span.memory_peak,
+        "error": (
+            f"({span.error.__class__.__name__}) {span.error}"
+            if span.error is not None
+            else None
+        ),
+    }
+
+
+def __summarize(spans: list[PhaseSpan]) -> dict[str, dict[str, Any]]:
+    # Totals by phase name, the wall time of nested phases is also included in
+    # the enclosing ones
+    phases: dict[str, dict[str, Any]] = {}
+    for span in spans:
+        item = phases.setdefault(
+            span.name,
+            {
+                "count": 0,
+                "wall_time": 0.0,
+                "requests": 0,
+                "sent_bytes": 0,
+                "received_bytes": 0,
+                "memory_peak": None,
+            },
+        )
+        item["count"] += 1
+        item["wall_time"] = round(item["wall_time"] + span.elapsed, 6)
+        item["requests"] += span.requests
+        item["sent_bytes"] += span.sent_bytes
+        item["received_bytes"] += span.received_bytes
+        if span.memory_peak is not None:
+            item["memory_peak"] = max(item["memory_peak"] or 0, span.memory_peak)
+    return phases
+
+
+def __top_allocations(snapshot: tracemalloc.Snapshot) -> list[dict[str, Any]]:
+    statistics = snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+    return [
+        {
+            "location": f"{x.traceback[0].filename}:{x.traceback[0].lineno}",
+            "size": x.size,
+            "count": x.count,
+        }
+        for x in statistics
+    ]
+
+
+def profile_cycle(mode: str, output_dir: str, cycle: Callable[[], None]) -> list[str]:
+    # Runs a cycle in the current thread, which is the only one cProfile sees,
+    # and writes the results to `output_dir`, returns the written paths
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unsupported profile mode: {mode}")
+    os.makedirs(output_dir, exist_ok=True)
+    prefix = os.path.join(output_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}")
+    recorder = SpanRecorder()
+    add_span_observer(recorder)
+    profiler: cProfile.Profile | None = None
+    snapshot: tracemalloc.Snapshot | None = None
+    started_at = time.time()
+    origin = time.perf_counter()
+    try:
+        if mode == "memory":
+            tracemalloc.start(TRACEBACK_DEPTH)
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            with phase("cycle"):
+                cycle()
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+    finally:
+        remove_span_observer(recorder)
+
+    paths = []
+    if profiler is not None:
+        profiler.dump_stats(prefix + ".pstats")
+        paths.append(prefix + ".pstats")
+    with recorder.lock:
+        spans = sorted(recorder.spans, key=lambda x: x.start)
+    root = next((x for x in spans if x.name == "cycle" and x.parents == ()), None)
+    trace = {
+        "mode": mode,
+        "started_at": started_at,
+        "wall_time": round(root.elapsed, 6) if root is not None else None,
+        "requests": root.requests if root is not None else None,
+        "memory_peak": root.memory_peak if root is not None else None,
+        "phases": __summarize(spans),
+        "spans": [__span_to_dict(x, origin) for x in spans],
+    }
+    if snapshot is not None:
+        trace["top_allocations"] = __top_allocations(snapshot)
+    with open(prefix + ".json", "w", encoding="utf-8") as f:
+        json.dump(trace, f, ensure_ascii=False, indent=2)
+    paths.append(prefix + ".json")
+    for name, item in sorted(trace["phases"].items(), key=lambda x: -x[1]["wall_time"]):
+        logger.info(
+            "Phase %s: %d time(s), %.3fs, %d request(s), %d bytes sent, %d received",
+            name,
+            item["count"],
+            item["wall_time"],
+            item["requests"],
+            item["sent_bytes"],
+            item["received_bytes"],
+        )
+    for path in paths:
+        logger.info("Profile written to %s", path)
+    return paths
@@ -1,28 +1,65 @@
+import collections
+import dataclasses
+import functools
+import hashlib
+import json
 import logging
-import random
-import time
-from typing import Any, Protocol
+from typing import Any, Callable, Protocol
 import dacite
+import requests
 
+from njupt_score_pusher import metrics
 from njupt_score_pusher.pusher.entity import MessageEntity
-from njupt_score_pusher.pusher.registry import PUSHER_REGISTRY
+from njupt_score_pusher.pusher.rate_limit import (
+    RateLimitConfig,
+    RateLimited,
+    get_token_bucket,
+)
+from njupt_score_pusher.pusher.registry import load_pusher_class
+from njupt_score_pusher.pusher.render import (
+    MARKUPS,
+    MessageFormat,
+    render_message,
+    render_sections,
+    summary_section,
+)
 
 logger = logging.getLogger(__name__)
 
 
+# A pusher may also declare `message_format` (plain text if not) and
+# `rate_limit` (`DEFAULT_RATE_LIMIT` if not)
 class Pusher(Protocol):
+    # Maximum length of a single text message
+    max_message_length: int
+
     def push(self, message: MessageEntity): ...
 
+    # Takes a text rendered in the pusher's `message_format`
+    def push_text(self, text: str): ...
+
+
+# Used for pushers without a `rate_limit` field
+DEFAULT_RATE_LIMIT = RateLimitConfig()
+
+
+@dataclasses.dataclass
+class BatchConfig:
+    enabled: bool = False
+    # Changes of a cycle are only batched when there are at least this many
+    min_items: int = 2
+    # Maximum number of changes in a single digest message
+    max_items: int = 20
+
 
 def build_pushers(params: list[dict[str, Any]]) -> list[Pusher]:
     pushers = []
     for param in params:
         try:
-            if param["type"] in PUSHER_REGISTRY:
+            pusher_class = load_pusher_class(param["type"])
+            if pusher_class is not None:
                 pusher_param = {k: v for k, v in param.items() if k != "type"}
-                pusher_instance = dacite.from_dict(
-                    PUSHER_REGISTRY[param["type"]], pusher_param
-                )
+                pusher_instance = dacite.from_dict(pusher_class, pusher_param)
                 pushers.append(pusher_instance)
             else:
                 raise ValueError("Unsupported pusher type")
@@ -32,16 +69,202 @@ def build_pushers(params: list[dict[str, Any]]) -> list[Pusher]:
     return pushers
 
 
-def do_push(message: MessageEntity, pushers: list[Pusher]):
-    for pusher in pushers:
+def pusher_key(pusher: Pusher) -> str:
+    # Identifies a pusher by its configuration, stable across restarts
+    if dataclasses.is_dataclass(pusher):
+        params = {
+            field.name: getattr(pusher, field.name)
+            for field in dataclasses.fields(pusher)
+            # Tuning fields such as the rate limit do not identify the pusher
+            if field.init and field.compare
+        }
+    else:
+        params = {}
+    params["type"] = pusher.__class__.__name__
+    encoded = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()[:16]
+
+
+def __digest_summary(
+    messages: list[MessageEntity], message_format: MessageFormat
+) -> str:
+    # The GPA moves over all the messages of a digest, from the figures before
+    # the first one to those after the last one
+    summaries = [x for x in messages if x.summary is not None]
+    if len(summaries) == 0:
+        return ""
+    last = summaries[-1]
+    assert last.summary is not None
+    first = summaries[0].summary
+    # The first change of the same term is the first one to touch that term
+    first_of_term = next(
+        x.summary
+        for x in summaries
+        if x.content.year == last.content.year and x.content.term == last.content.term
+    )
+    assert first is not None and first_of_term is not None
+    summary = dataclasses.replace(
+        last.summary,
+        gpa_before=first.gpa_before,
+        term_gpa_before=first_of_term.term_gpa_before,
+    )
+    return render_sections([summary_section(last.content, summary)], message_format)
+
+
+def __truncated_message(
+    message: MessageEntity, message_format: MessageFormat, limit: int
+) -> str:
+    text = render_message(message, message_format, with_summary=False)
+    if len(text) <= limit:
+        return text
+    # Cutting the markup could leave it unbalanced, so the plain text is cut
+    # and escaped instead
+    escape = MARKUPS[message_format].escape
+    plain = render_message(message, MessageFormat.PLAIN, with_summary=False)[:limit]
+    text = escape(plain)
+    while len(text) > limit:
+        plain = plain[: len(plain) - (len(text) - limit)]
+        text = escape(plain)
+    return text
+
+
+def build_digests(
+    messages: list[MessageEntity],
+    max_length: int,
+    max_items: int,
+    message_format: MessageFormat = MessageFormat.PLAIN,
+) -> list[tuple[str, int]]:
+    # Returns the digest texts with the number of messages each one covers
+    # Leaves room for the header, which is only known after splitting
+    header_reserve = 48
+    body_limit = max(max_length - header_reserve, 1)
+    bodies: list[list[str]] = []
+    groups: list[list[MessageEntity]] = []
+    current: list[str] = []
+    current_group: list[MessageEntity] = []
+    current_length = 0
+    for message in messages:
+        text = __truncated_message(message, message_format, body_limit)
+        # The GPA summary is shown once at the end of each digest
+        summary_length = len(__digest_summary([message], message_format))
+        if len(current) != 0 and (
+            len(current) >= max_items
+            or current_length + len(text) + summary_length + 2 > body_limit
+        ):
+            bodies.append(current)
+            groups.append(current_group)
+            current = []
+            current_group = []
+            current_length = 0
+        current.append(text)
+        current_group.append(message)
+        current_length += len(text) + 1
+    if len(current) != 0:
+        bodies.append(current)
+        groups.append(current_group)
+    digests = []
+    for i, body in enumerate(bodies):
+        title = "成绩变动汇总"
+        if len(bodies) > 1:
+            title += f"（{i + 1}/{len(bodies)}）"
+        header = render_sections(
+            [(title, [("", f"共 {len(messages)} 项")])], message_format
+        )
+        text = header + "\n" + "\n".join(body)
+        summary = __digest_summary(groups[i], message_format)
+        if summary != "" and len(text) + len(summary) + 1 <= max_length:
+            text += "\n" + summary
+        digests.append((text, len(body)))
+    return digests
+
+
+def is_permanent_failure(error: Exception) -> bool:
+    # The API refused the request itself, e.g. 400 for a message it cannot
+    # parse or that is too long, so sending it again would fail the same way.
+    # Network errors and 5xx responses are transient, 429 is a rate limit.
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return 400 <= status < 500 and status not in (408, 429)
+    return False
+
+
+@dataclasses.dataclass
+class PushResult:
+    # Number of leading messages that have been handled, either delivered or
+    # rejected for good, the others are left to be retried
+    handled: int = 0
+    # Index of each handled message rejected for good -> the error
+    rejected: dict[int, str] = dataclasses.field(default_factory=dict)
+    # Why the push stopped before the end, if it did
+    error: Exception | None = None
+
+
+def push_messages(
+    pusher: Pusher, messages: list[MessageEntity], batch_config: BatchConfig
+) -> PushResult:
+    # Pushes the messages in order and stops at the first transient failure. A
+    # message rejected for good is skipped, so that it does not hold back the
+    # ones after it.
+    name = pusher.__class__.__name__
+    bucket = get_token_bucket(
+        pusher_key(pusher), getattr(pusher, "rate_limit", DEFAULT_RATE_LIMIT)
+    )
+    message_format = getattr(pusher, "message_format", MessageFormat.PLAIN)
+
+    def single(index: int) -> tuple[str, int, int, Callable[[], None]]:
+        text = render_message(messages[index], message_format)
+        return "message", index, 1, functools.partial(pusher.push_text, text)
+
+    # (kind, index of the first message, number of messages, send)
+    sends: collections.deque[tuple[str, int, int, Callable[[], None]]] = (
+        collections.deque()
+    )
+    if batch_config.enabled and len(messages) >= max(batch_config.min_items, 1):
+        digests = build_digests(
+            messages,
+            pusher.max_message_length,
+            max(batch_config.max_items, 1),
+            message_format,
+        )
+        start = 0
+        for text, count in digests:
+            sends.append(
+                ("digest", start, count, functools.partial(pusher.push_text, text))
+            )
+            start += count
+    else:
+        sends.extend(single(i) for i in range(len(messages)))
+    result = PushResult()
+    while len(sends) != 0:
+        kind, start, count, send = sends.popleft()
+        # Still throttled, the rest is left to be retried after the pause
+        paused_for = bucket.paused_for()
+        if paused_for > 0:
+            result.error = RateLimited(paused_for)
+            return result
+        bucket.acquire()
         try:
-            pusher.push(message)
+            send()
+        except RateLimited as e:
+            metrics.PUSH_THROTTLED.inc(name)
+            bucket.pause(e.retry_after)
+            logger.warning("Rate limited by %s, retry after %.1fs", name, e.retry_after)
+            result.error = e
+            return result
         except Exception as e:  # pylint: disable=broad-except
+            metrics.PUSH_FAILURES.inc(name)
             _type = e.__class__.__name__
-            logging.error(
-                "Failed to push message to %s: (%s) %s",
-                pusher.__class__.__name__,
-                _type,
-                e,
-            )
-        time.sleep(random.uniform(0.5, 1.0))
+            logger.error("Failed to push %s to %s: (%s) %s", kind, name, _type, e)
+            if not is_permanent_failure(e):
+                result.error = e
+                return result
+            if count > 1:
+                # Rejected for one of its messages, which are sent one by one
+                # instead to find it
+                sends.extendleft(
+                    single(i) for i in reversed(range(start, start + count))
+                )
+                continue
+            result.rejected[start] = f"({_type}) {e}"
+        result.handled = start + count
+    return result
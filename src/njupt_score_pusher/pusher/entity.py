@@ -1,7 +1,7 @@
 import dataclasses
 import enum
 import logging
-from typing import Optional
+from typing import Any, Optional
 from njupt_score_pusher.njupt_eas import CourseScoreInfo
 
 logger = logging.getLogger(__name__)
@@ -14,74 +14,51 @@ class MessageType(enum.Enum):
     REMOVED = 3
 
 
+# GPA figures right after the change, computed by `analytics`
+@dataclasses.dataclass
+class GpaSummary:
+    # Credit-weighted GPA of the whole transcript
+    gpa_before: float
+    gpa: float
+    # Credit-weighted GPA of the term of the course
+    term_gpa_before: float
+    term_gpa: float
+    # 必修 / 选修
+    required_gpa: float
+    elective_gpa: float
+    credits_earned: float
+
+
 @dataclasses.dataclass
 class MessageEntity:
     type: MessageType
     content: CourseScoreInfo
     prev: Optional[CourseScoreInfo] = None
+    summary: Optional[GpaSummary] = None
+    # Texts rendered by `render`, keyed by format and whether with the summary
+    rendered: dict[tuple[str, bool], str] = dataclasses.field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
 
 
-def ___text_message_when_new(course: CourseScoreInfo) -> str:
-    info = "【新成绩】\n"
-    info += f"课程：{course.id()} {course.course_name} （{course.course_nature}）\n"
-    info += f"成绩：{course.score}\n"
-    if course.makeup_score != "":
-        info += f"补考成绩：{course.makeup_score}\n"
-    if course.retake_score != "":
-        info += f"重修成绩：{course.retake_score}\n"
-    info += f"学分：{course.credit}\n"
-    info += f"绩点：{course.gpa}\n"
-    return info
-
-
-def ___text_message_when_updated(prev: CourseScoreInfo, course: CourseScoreInfo) -> str:
-    info = "【成绩更新】\n"
-    info += f"课程：{course.id()} {course.course_name} （{course.course_nature}）\n"
-    if course.score != prev.score:
-        info += f"成绩：{prev.score} → {course.score}\n"
-    else:
-        info += f"成绩：{course.score}\n"
-    if course.makeup_score != prev.makeup_score:
-        info += f"补考成绩：{prev.makeup_score} → {course.makeup_score}\n"
-    elif course.makeup_score != "":
-        info += f"补考成绩：{course.makeup_score}\n"
-    if course.retake_score != prev.retake_score:
-        info += f"重修成绩：{prev.retake_score} → {course.retake_score}\n"
-    elif course.retake_score != "":
-        info += f"重修成绩：{course.retake_score}\n"
-    if course.credit != prev.credit:
-        info += f"学分：{prev.credit} → {course.credit}\n"
-    else:
-        info += f"学分：{course.credit}\n"
-    if course.gpa != prev.gpa:
-        info += f"绩点：{prev.gpa} → {course.gpa}\n"
-    else:
-        info += f"绩点：{course.gpa}\n"
-    return info
-
-
-def ___text_message_when_removed(course: CourseScoreInfo) -> str:
-    info = "【成绩移除】\n"
-    info += f"课程：{course.id()} {course.course_name} （{course.course_nature}）\n"
-    info += f"成绩：{course.score}\n"
-    if course.makeup_score != "":
-        info += f"补考成绩：{course.makeup_score}\n"
-    if course.retake_score != "":
-        info += f"重修成绩：{course.retake_score}\n"
-    info += f"学分：{course.credit}\n"
-    info += f"绩点：{course.gpa}\n"
-    return info
+def message_to_dict(entity: MessageEntity) -> dict[str, Any]:
+    return {
+        "type": entity.type.name,
+        "content": dataclasses.asdict(entity.content),
+        "prev": dataclasses.asdict(entity.prev) if entity.prev is not None else None,
+        "summary": (
+            dataclasses.asdict(entity.summary) if entity.summary is not None else None
+        ),
+    }
 
 
-def build_text_message(entity: MessageEntity) -> str:
-    if entity.type == MessageType.NEW:
-        return ___text_message_when_new(entity.content)
-    if entity.type == MessageType.UPDATED:
-        if entity.prev is None:
-            logger.error("No previous data for updated message")
-            return ""
-        return ___text_message_when_updated(entity.prev, entity.content)
-    if entity.type == MessageType.REMOVED:
-        return ___text_message_when_removed(entity.content)
-    logger.error("Unsupported message type: %s", entity.type)
-    return ""
+def message_from_dict(data: dict[str, Any]) -> MessageEntity:
+    return MessageEntity(
+        type=MessageType[data["type"]],
+        content=CourseScoreInfo(**data["content"]),
+        prev=CourseScoreInfo(**data["prev"]) if data["prev"] is not None else None,
+        # Messages queued by older versions carry no summary
+        summary=(
+            GpaSummary(**data["summary"]) if data.get("summary") is not None else None
+        ),
+    )
@@ -0,0 +1,413 @@
+import collections
+import concurrent.futures
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from njupt_score_pusher.phases import phase
+from njupt_score_pusher.pusher.common import (
+    BatchConfig,
+    Pusher,
+    pusher_key,
+    push_messages,
+)
+from njupt_score_pusher.pusher.entity import (
+    MessageEntity,
+    message_from_dict,
+    message_to_dict,
+)
+from njupt_score_pusher.pusher.rate_limit import RateLimited
+
+logger = logging.getLogger(__name__)
+
+# Delivered messages are kept this long (seconds) to recognize a change that is
+# detected again after a crash before the snapshot commit
+DEDUP_WINDOW = 24 * 60 * 60
+# Decoded messages kept for sharing their rendered texts between pushers
+DECODED_CACHE_SIZE = 1024
+
+_decoded_lock = threading.Lock()
+_decoded: collections.OrderedDict[str, MessageEntity] = collections.OrderedDict()
+
+
+def _decode_message(dedup_key: str, encoded: str) -> MessageEntity:
+    # Every pusher of a change has its own row with the same message, decoding
+    # them to the same entity lets them reuse its rendered texts
+    with _decoded_lock:
+        message = _decoded.get(dedup_key)
+        if message is not None:
+            _decoded.move_to_end(dedup_key)
+            return message
+    message = message_from_dict(json.loads(encoded))
+    with _decoded_lock:
+        _decoded[dedup_key] = message
+        while len(_decoded) > DECODED_CACHE_SIZE:
+            _decoded.popitem(last=False)
+    return message
+
+
+@dataclasses.dataclass
+class OutboxConfig:
+    # Base and maximum delay of the exponential retry backoff, in seconds
+    retry_base_delay: float = 30
+    retry_max_delay: float = 60 * 60
+    # Undelivered messages older than this are dropped (seconds), <= 0 to keep
+    max_age: float = 7 * 24 * 60 * 60
+    # How often the background sender checks for due messages, in seconds
+    poll_interval: float = 15
+    # Maximum number of pushers delivering at the same time
+    max_workers: int = 4
+    # In oneshot mode, how long to wait for rate limited messages before
+    # leaving them to the next run, in seconds
+    flush_timeout: float = 60
+
+
+@dataclasses.dataclass
+class OutboxItem:
+    id: int
+    message: MessageEntity
+    attempts: int
+
+
+class Outbox:
+    def __init__(self, path: str, config: OutboxConfig):
+        self.config = config
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "pusher_key TEXT NOT NULL, "
+                "dedup_key TEXT NOT NULL, "
+                "message TEXT NOT NULL, "
+                "created_at REAL NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL, "
+                "delivered_at REAL, "
+                "last_error TEXT, "
+                # Rejected for good by the pusher, never retried
+                "dead_at REAL)"
+            )
+            columns = [x[1] for x in self.conn.execute("PRAGMA table_info(outbox)")]
+            # Added after the first version of the table
+            if "dead_at" not in columns:
+                self.conn.execute("ALTER TABLE outbox ADD COLUMN dead_at REAL")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_pending "
+                "ON outbox (pusher_key, delivered_at, next_attempt_at)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS outbox_dedup "
+                "ON outbox (pusher_key, dedup_key)"
+            )
+
+    # `version` is the version of the snapshot the messages were diffed against,
+    # so that only the same change detected again from the same snapshot (a
+    # replay after a crash) is deduplicated, and not a real repeated change
+    def enqueue(
+        self, pusher_keys: list[str], messages: list[MessageEntity], version: str = ""
+    ) -> int:
+        now = time.time()
+        queued = 0
+        with self.conn:
+            for message in messages:
+                encoded = json.dumps(
+                    message_to_dict(message), ensure_ascii=False, sort_keys=True
+                )
+                dedup_key = hashlib.sha256(
+                    f"{version}\x1e{encoded}".encode("utf-8")
+                ).hexdigest()
+                for key in pusher_keys:
+                    duplicated = self.conn.execute(
+                        "SELECT 1 FROM outbox WHERE pusher_key = ? AND dedup_key = ? "
+                        "AND (delivered_at IS NULL OR created_at > ?)",
+                        (key, dedup_key, now - DEDUP_WINDOW),
+                    ).fetchone()
+                    if duplicated is not None:
+                        continue
+                    self.conn.execute(
+                        "INSERT INTO outbox "
+                        "(pusher_key, dedup_key, message, created_at, next_attempt_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (key, dedup_key, encoded, now, now),
+                    )
+                    queued += 1
+        return queued
+
+    def due_items(self, key: str, limit: int = 100) -> list[OutboxItem]:
+        rows = self.conn.execute(
+            "SELECT id, dedup_key, message, attempts FROM outbox "
+            "WHERE pusher_key = ? AND delivered_at IS NULL AND dead_at IS NULL "
+            "AND next_attempt_at <= ? "
+            "ORDER BY id LIMIT ?",
+            (key, time.time(), limit),
+        )
+        return [
+            OutboxItem(
+                id=item_id,
+                message=_decode_message(dedup_key, message),
+                attempts=attempts,
+            )
+            for item_id, dedup_key, message, attempts in rows
+        ]
+
+    def mark_delivered(self, items: list[OutboxItem]):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET delivered_at = ?, last_error = NULL WHERE id = ?",
+                [(now, item.id) for item in items],
+            )
+
+    def mark_failed(self, items: list[OutboxItem], error: str):
+        if len(items) == 0:
+            return
+        # The items are retried together to keep them in order
+        attempts = items[0].attempts + 1
+        delay = min(
+            self.config.retry_base_delay * 2 ** (attempts - 1),
+            self.config.retry_max_delay,
+        )
+        next_attempt_at = time.time() + delay * random.uniform(0.5, 1.0)
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, "
+                "last_error = ? WHERE id = ?",
+                [(next_attempt_at, error, item.id) for item in items],
+            )
+
+    def mark_dead(self, items: list[OutboxItem], error: str):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, dead_at = ?, "
+                "last_error = ? WHERE id = ?",
+                [(now, error, item.id) for item in items],
+            )
+
+    def defer(self, items: list[OutboxItem], delay: float, error: str):
+        # Throttled rather than failed, so the attempt is not counted
+        next_attempt_at = time.time() + delay
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET next_attempt_at = ?, last_error = ? WHERE id = ?",
+                [(next_attempt_at, error, item.id) for item in items],
+            )
+
+    def purge(self) -> int:
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM outbox "
+                "WHERE (delivered_at IS NOT NULL OR dead_at IS NOT NULL) "
+                "AND created_at < ?",
+                (now - DEDUP_WINDOW,),
+            )
+            if self.config.max_age <= 0:
+                return 0
+            dropped = self.conn.execute(
+                "DELETE FROM outbox "
+                "WHERE delivered_at IS NULL AND dead_at IS NULL AND created_at < ?",
+                (now - self.config.max_age,),
+            ).rowcount
+        return dropped
+
+    def close(self):
+        self.conn.close()
+
+
+@dataclasses.dataclass
+class _OutboxTarget:
+    name: str
+    path: str
+    pushers: list[Pusher]
+
+
+class OutboxSender:
+    def __init__(self, config: OutboxConfig, batch_config: BatchConfig):
+        self.config = config
+        self.batch_config = batch_config
+        self.lock = threading.Lock()
+        self.targets: dict[str, _OutboxTarget] = {}
+        self.wake_event = threading.Event()
+        # When deferred messages become due, earlier than the next poll
+        self.wake_at: float | None = None
+        self.stop_event = threading.Event()
+        self.thread: threading.Thread | None = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max(config.max_workers, 1), thread_name_prefix="pusher"
+        )
+
+    def register(self, name: str, path: str, pushers: list[Pusher]):
+        with self.lock:
+            self.targets[name] = _OutboxTarget(name, path, pushers)
+
+    def unregister(self, name: str):
+        with self.lock:
+            self.targets.pop(name, None)
+
+    def reconfigure(self, config: OutboxConfig, batch_config: BatchConfig):
+        # The size of the worker pool is kept until restart
+        with self.lock:
+            self.config = config
+            self.batch_config = batch_config
+
+    def wake(self):
+        self.wake_event.set()
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.__run, name="outbox-sender", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.executor.shutdown()
+
+    def drain_once(self, inline: bool = False):
+        with self.lock:
+            targets = list(self.targets.values())
+        # Deliveries through the same pusher run one after another to keep its
+        # pacing, different pushers are served concurrently
+        groups: dict[str, list[tuple[_OutboxTarget, Pusher]]] = {}
+        for target in targets:
+            if not os.path.exists(target.path):
+                continue
+            try:
+                self.__purge_target(target)
+            except Exception as e:  # pylint: disable=broad-except
+                _type = e.__class__.__name__
+                logger.error(
+                    "[%s] Failed to purge outbox: (%s) %s", target.name, _type, e
+                )
+            for pusher in target.pushers:
+                groups.setdefault(pusher_key(pusher), []).append((target, pusher))
+        if inline:
+            # In the calling thread, e.g. to be seen by a profiler
+            for key, group in groups.items():
+                self.__drain_group(key, group)
+            return
+        futures = [
+            self.executor.submit(self.__drain_group, key, group)
+            for key, group in groups.items()
+        ]
+        concurrent.futures.wait(futures)
+
+    def flush(self, timeout: float, inline: bool = False):
+        # Drains until no message is deferred by a rate limit, or until the
+        # deferred ones are not due before the timeout
+        deadline = time.time() + timeout
+        while True:
+            self.drain_once(inline)
+            with self.lock:
+                wake_at = self.wake_at
+                self.wake_at = None
+            if wake_at is None or wake_at > deadline:
+                return
+            time.sleep(max(wake_at - time.time(), 0))
+
+    def __run(self):
+        while not self.stop_event.is_set():
+            self.drain_once()
+            timeout = self.config.poll_interval
+            with self.lock:
+                if self.wake_at is not None:
+                    timeout = min(max(self.wake_at - time.time(), 0), timeout)
+                    self.wake_at = None
+            self.wake_event.wait(timeout)
+            self.wake_event.clear()
+
+    def __wake_after(self, delay: float):
+        with self.lock:
+            wake_at = time.time() + delay
+            if self.wake_at is None or wake_at < self.wake_at:
+                self.wake_at = wake_at
+
+    def __purge_target(self, target: _OutboxTarget):
+        outbox = Outbox(target.path, self.config)
+        try:
+            dropped = outbox.purge()
+        finally:
+            outbox.close()
+        if dropped != 0:
+            logger.warning(
+                "[%s] Dropped %d undelivered message(s) older than %.0fs",
+                target.name,
+                dropped,
+                self.config.max_age,
+            )
+
+    def __drain_group(self, key: str, group: list[tuple[_OutboxTarget, Pusher]]):
+        for target, pusher in group:
+            try:
+                self.__drain_pusher(target, key, pusher)
+            except Exception as e:  # pylint: disable=broad-except
+                _type = e.__class__.__name__
+                logger.error(
+                    "[%s] Failed to drain outbox: (%s) %s", target.name, _type, e
+                )
+
+    def __drain_pusher(self, target: _OutboxTarget, key: str, pusher: Pusher):
+        outbox = Outbox(target.path, self.config)
+        try:
+            while True:
+                items = outbox.due_items(key)
+                if len(items) == 0:
+                    return
+                with phase("push"):
+                    result = push_messages(
+                        pusher, [item.message for item in items], self.batch_config
+                    )
+                outbox.mark_delivered(
+                    [
+                        item
+                        for i, item in enumerate(items[: result.handled])
+                        if i not in result.rejected
+                    ]
+                )
+                for i, rejection in result.rejected.items():
+                    outbox.mark_dead([items[i]], rejection)
+                    logger.error(
+                        "[%s] Message %d rejected by %s for good, dropped: %s",
+                        target.name,
+                        items[i].id,
+                        pusher.__class__.__name__,
+                        rejection,
+                    )
+                error = result.error
+                handled = result.handled
+                if isinstance(error, RateLimited):
+                    outbox.defer(items[handled:], error.retry_after, str(error))
+                    self.__wake_after(error.retry_after)
+                    logger.info(
+                        "[%s] %d message(s) to %s deferred for %.1fs",
+                        target.name,
+                        len(items) - handled,
+                        pusher.__class__.__name__,
+                        error.retry_after,
+                    )
+                    return
+                if error is not None:
+                    outbox.mark_failed(
+                        items[handled:], f"({error.__class__.__name__}) {error}"
+                    )
+                    logger.warning(
+                        "[%s] %d message(s) to %s will be retried",
+                        target.name,
+                        len(items) - handled,
+                        pusher.__class__.__name__,
+                    )
+                    return
+        finally:
+            outbox.close()
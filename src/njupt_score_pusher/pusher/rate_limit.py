@@ -0,0 +1,112 @@
+import dataclasses
+import email.utils
+import logging
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class RateLimitConfig:
+    # Sustained messages per second
+    rate: float = 1.0
+    # Messages that can be sent at once after being idle
+    burst: int = 3
+
+
+# Assumed when a throttled response does not tell how long to wait (seconds)
+DEFAULT_RETRY_AFTER = 30.0
+
+
+class RateLimited(Exception):
+    # Raised by a pusher when the API throttles it, `retry_after` in seconds
+    def __init__(self, retry_after: float, message: str = ""):
+        super().__init__(message or f"Rate limited, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def retry_after_from_response(response: requests.Response) -> float | None:
+    # The Retry-After header holds either seconds or an HTTP date; Telegram
+    # puts it in the body as `parameters.retry_after` instead
+    header = response.headers.get("Retry-After")
+    if header is not None:
+        try:
+            return max(float(header), 0.0)
+        except ValueError:
+            pass
+        try:
+            date = email.utils.parsedate_to_datetime(header)
+            return max(date.timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            logger.warning("Invalid Retry-After header: %s", header)
+    try:
+        retry_after = response.json()["parameters"]["retry_after"]
+        return max(float(retry_after), 0.0)
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, config: RateLimitConfig):
+        self.config = config
+        self.__lock = threading.Lock()
+        self.__tokens = float(max(config.burst, 1))
+        # Tokens accrue from this time on, which is in the future while paused
+        self.__updated_at = time.monotonic()
+
+    def __refill(self, now: float):
+        capacity = float(max(self.config.burst, 1))
+        if self.config.rate <= 0:
+            self.__tokens = capacity
+        elif now > self.__updated_at:
+            elapsed = now - self.__updated_at
+            self.__tokens = min(self.__tokens + elapsed * self.config.rate, capacity)
+            self.__updated_at = now
+
+    def reserve(self) -> float:
+        # Takes a token and returns how long to wait before using it
+        with self.__lock:
+            now = time.monotonic()
+            self.__refill(now)
+            self.__tokens -= 1
+            wait = max(self.__updated_at - now, 0.0)
+            if self.__tokens < 0 and self.config.rate > 0:
+                wait += -self.__tokens / self.config.rate
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, delay: float):
+        # Throttled by the API: nothing is sent until the delay elapses, then a
+        # single message goes out and the others follow at the sustained rate
+        with self.__lock:
+            resume_at = time.monotonic() + delay
+            if resume_at > self.__updated_at:
+                self.__updated_at = resume_at
+                self.__tokens = min(self.__tokens, 1.0)
+
+    def paused_for(self) -> float:
+        with self.__lock:
+            return max(self.__updated_at - time.monotonic(), 0.0)
+
+
+__lock = threading.Lock()
+__buckets: dict[str, TokenBucket] = {}
+
+
+def get_token_bucket(key: str, config: RateLimitConfig) -> TokenBucket:
+    # Shared by every account pushing through the same pusher configuration
+    with __lock:
+        bucket = __buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(config)
+            __buckets[key] = bucket
+        else:
+            bucket.config = config
+        return bucket
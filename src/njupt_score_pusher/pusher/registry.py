@@ -1,6 +1,23 @@
-from njupt_score_pusher.pusher.telegram import TelegramPusher
-
+import importlib
+from typing import Any
 
+# Pusher types and the "module:class" paths of their implementations, imported
+# only when a pusher of the type is configured
 PUSHER_REGISTRY = {
-    "telegram": TelegramPusher,
+    "telegram": "njupt_score_pusher.pusher.telegram:TelegramPusher",
 }
+# Pushers of other packages register themselves as entry points in this group
+PUSHER_ENTRY_POINT_GROUP = "njupt_score_pusher.pushers"
+
+
+def load_pusher_class(pusher_type: str) -> Any:
+    path = PUSHER_REGISTRY.get(pusher_type)
+    if path is not None:
+        module_name, _, class_name = path.partition(":")
+        return getattr(importlib.import_module(module_name), class_name)
+    from importlib import metadata
+
+    for entry_point in metadata.entry_points(group=PUSHER_ENTRY_POINT_GROUP):
+        if entry_point.name == pusher_type:
+            return entry_point.load()
+    return None
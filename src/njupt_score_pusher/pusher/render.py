@@ -0,0 +1,152 @@
+import dataclasses
+import enum
+import html
+import logging
+import re
+from typing import Callable
+from njupt_score_pusher.njupt_eas import CourseScoreInfo
+from njupt_score_pusher.pusher.entity import GpaSummary, MessageEntity, MessageType
+
+logger = logging.getLogger(__name__)
+
+
+@enum.unique
+class MessageFormat(enum.Enum):
+    PLAIN = "plain"
+    # Escaped for Telegram's MarkdownV2, which is also valid CommonMark
+    MARKDOWN = "markdown"
+    HTML = "html"
+
+
+# A message is a list of sections, each with a title and labelled lines (shown
+# as is without a label), built once per message and laid out by the markup of
+# each format
+Line = tuple[str, str]
+Section = tuple[str, list[Line]]
+
+MARKDOWN_SPECIAL_PATTERN = re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])")
+
+
+@dataclasses.dataclass(frozen=True)
+class _Markup:
+    # str.format templates, with the arguments already escaped
+    title: str
+    line: str
+    escape: Callable[[str], str]
+
+    def render(self, sections: list[Section]) -> str:
+        parts = []
+        for title, lines in sections:
+            parts.append(self.title.format(self.escape(title)))
+            for label, value in lines:
+                if label == "":
+                    parts.append(self.escape(value) + "\n")
+                else:
+                    parts.append(
+                        self.line.format(self.escape(label), self.escape(value))
+                    )
+        return "".join(parts)
+
+
+MARKUPS = {
+    MessageFormat.PLAIN: _Markup("【{}】\n", "{}：{}\n", lambda x: x),
+    MessageFormat.MARKDOWN: _Markup(
+        "*【{}】*\n",
+        "{}：{}\n",
+        lambda x: MARKDOWN_SPECIAL_PATTERN.sub(r"\\\1", x),
+    ),
+    MessageFormat.HTML: _Markup(
+        "<b>【{}】</b>\n", "{}：{}\n", lambda x: html.escape(x, quote=False)
+    ),
+}
+
+
+def __move(before, after) -> str:
+    return f"{before} → {after}" if before != after else f"{after}"
+
+
+def __course_lines(course: CourseScoreInfo) -> list[Line]:
+    lines = [
+        ("课程", f"{course.id()} {course.course_name} （{course.course_nature}）"),
+        ("成绩", course.score),
+    ]
+    if course.makeup_score != "":
+        lines.append(("补考成绩", course.makeup_score))
+    if course.retake_score != "":
+        lines.append(("重修成绩", course.retake_score))
+    lines.append(("学分", f"{course.credit}"))
+    lines.append(("绩点", f"{course.gpa}"))
+    return lines
+
+
+def __updated_lines(prev: CourseScoreInfo, course: CourseScoreInfo) -> list[Line]:
+    lines = [
+        ("课程", f"{course.id()} {course.course_name} （{course.course_nature}）"),
+        ("成绩", __move(prev.score, course.score)),
+    ]
+    if course.makeup_score != "" or prev.makeup_score != "":
+        lines.append(("补考成绩", __move(prev.makeup_score, course.makeup_score)))
+    if course.retake_score != "" or prev.retake_score != "":
+        lines.append(("重修成绩", __move(prev.retake_score, course.retake_score)))
+    lines.append(("学分", __move(prev.credit, course.credit)))
+    lines.append(("绩点", __move(prev.gpa, course.gpa)))
+    return lines
+
+
+def __gpa_move(before: float, after: float) -> str:
+    if abs(after - before) < 5e-5:
+        return f"{after:.4f}"
+    return f"{before:.4f} → {after:.4f}（{after - before:+.4f}）"
+
+
+def summary_section(course: CourseScoreInfo, summary: GpaSummary) -> Section:
+    return (
+        "绩点",
+        [
+            ("总绩点", __gpa_move(summary.gpa_before, summary.gpa)),
+            (
+                f"{course.year} 第{course.term}学期",
+                __gpa_move(summary.term_gpa_before, summary.term_gpa),
+            ),
+            ("必修", f"{summary.required_gpa:.4f}"),
+            ("选修", f"{summary.elective_gpa:.4f}"),
+            ("已获学分", f"{summary.credits_earned:g}"),
+        ],
+    )
+
+
+def message_sections(entity: MessageEntity, with_summary: bool = True) -> list[Section]:
+    if entity.type == MessageType.NEW:
+        sections = [("新成绩", __course_lines(entity.content))]
+    elif entity.type == MessageType.UPDATED:
+        if entity.prev is None:
+            logger.error("No previous data for updated message")
+            return []
+        sections = [("成绩更新", __updated_lines(entity.prev, entity.content))]
+    elif entity.type == MessageType.REMOVED:
+        sections = [("成绩移除", __course_lines(entity.content))]
+    else:
+        logger.error("Unsupported message type: %s", entity.type)
+        return []
+    if with_summary and entity.summary is not None:
+        sections.append(summary_section(entity.content, entity.summary))
+    return sections
+
+
+def render_sections(sections: list[Section], message_format: MessageFormat) -> str:
+    return MARKUPS[message_format].render(sections)
+
+
+def render_message(
+    entity: MessageEntity,
+    message_format: MessageFormat = MessageFormat.PLAIN,
+    with_summary: bool = True,
+) -> str:
+    # Rendered once per format and kept on the entity, which the outbox shares
+    # between the pushers of the same message
+    key = (message_format.value, with_summary)
+    text = entity.rendered.get(key)
+    if text is None:
+        text = render_sections(message_sections(entity, with_summary), message_format)
+        entity.rendered[key] = text
+    return text
@@ -2,7 +2,22 @@ import dataclasses
 
 import requests
 
-from njupt_score_pusher.pusher.entity import MessageEntity, build_text_message
+from njupt_score_pusher.pusher.entity import MessageEntity
+from njupt_score_pusher.pusher.rate_limit import (
+    DEFAULT_RETRY_AFTER,
+    RateLimitConfig,
+    RateLimited,
+    retry_after_from_response,
+)
+from njupt_score_pusher.pusher.render import MessageFormat, render_message
+from njupt_score_pusher.timeouts import TimeoutConfig, TimeoutSession
+
+# Telegram's parse_mode -> the format of the texts
+PARSE_MODES = {
+    "": MessageFormat.PLAIN,
+    "MarkdownV2": MessageFormat.MARKDOWN,
+    "HTML": MessageFormat.HTML,
+}
 
 
 @dataclasses.dataclass
@@ -10,9 +25,43 @@ class TelegramPusher:
     token: str
     chat_id: str
     api_base: str = "https://api.telegram.org"
+    max_message_length: int = 4096
+    # "HTML", "MarkdownV2" or "" for plain text
+    parse_mode: str = dataclasses.field(default="HTML", compare=False)
+    # About one message per second per chat, short bursts are tolerated
+    rate_limit: RateLimitConfig = dataclasses.field(
+        default_factory=RateLimitConfig, compare=False
+    )
+    # Kept alive between messages to reuse the connection, never retried to
+    # avoid sending a message twice
+    session: requests.Session = dataclasses.field(
+        init=False,
+        repr=False,
+        compare=False,
+        default_factory=lambda: TimeoutSession(TimeoutConfig(), retries=0),
+    )
+
+    def __post_init__(self):
+        if self.parse_mode not in PARSE_MODES:
+            raise ValueError(f"Unsupported parse mode: {self.parse_mode}")
+
+    @property
+    def message_format(self) -> MessageFormat:
+        return PARSE_MODES[self.parse_mode]
 
     def push(self, message: MessageEntity):
+        self.push_text(render_message(message, self.message_format))
+
+    def push_text(self, text: str):
         url = f"{self.api_base}/bot{self.token}/sendMessage"
-        params = {"chat_id": self.chat_id, "text": build_text_message(message)}
-        response = requests.get(url, params=params, timeout=10)
+        params = {"chat_id": self.chat_id, "text": text}
+        if self.parse_mode != "":
+            params["parse_mode"] = self.parse_mode
+        # In the body, a long digest would not fit in a URL
+        response = self.session.post(url, data=params, timeout=10)
+        if response.status_code == 429:
+            retry_after = retry_after_from_response(response)
+            raise RateLimited(
+                retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+            )
         response.raise_for_status()
@@ -0,0 +1,186 @@
+import collections
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from njupt_score_pusher.storage import open_score_store
+
+logger = logging.getLogger(__name__)
+
+
+# Responses kept for unchanged stores, least recently used first out
+RESPONSE_CACHE_SIZE = 256
+
+
+@dataclasses.dataclass
+class QueryApiConfig:
+    listen: str = "127.0.0.1"
+    port: int = 9109
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+# Serves what the scrapes have stored, reads never reach the university
+class QueryApi:
+    def __init__(self, storage: str, data_dirs: dict[str, str]):
+        self.storage = storage
+        # Username -> data directory
+        self.data_dirs = data_dirs
+        self.lock = threading.Lock()
+        # (username, resource, since, limit) -> (store version, body, ETag) of
+        # the last response, bounded since the query is chosen by the client
+        self.cache: collections.OrderedDict[
+            tuple[str, str, int, int], tuple[str, bytes, str]
+        ] = collections.OrderedDict()
+
+    # Called when the configuration is reloaded
+    def update(self, storage: str, data_dirs: dict[str, str]):
+        with self.lock:
+            self.storage = storage
+            self.data_dirs = data_dirs
+            self.cache.clear()
+
+    # Returns the status and, for 200, the body and its ETag
+    def handle(self, path: str, query: str) -> tuple[int, bytes, str]:
+        with self.lock:
+            storage, data_dirs = self.storage, self.data_dirs
+        parts = [urllib.parse.unquote(x) for x in path.strip("/").split("/")]
+        if parts == ["accounts"]:
+            body = json.dumps({"accounts": sorted(data_dirs)}).encode("utf-8")
+            return 200, body, _etag(body)
+        if len(parts) != 3 or parts[0] != "accounts":
+            return 404, b"", ""
+        username, resource = parts[1], parts[2]
+        if username not in data_dirs or resource not in ("scores", "changes"):
+            return 404, b"", ""
+        # Not scraped yet
+        if not os.path.isdir(data_dirs[username]):
+            return 404, b"", ""
+        params = urllib.parse.parse_qs(query)
+        try:
+            since = int(params.get("since", ["0"])[0])
+            limit = min(max(int(params.get("limit", ["100"])[0]), 1), 1000)
+        except ValueError:
+            return 400, b"", ""
+        try:
+            # Reads never write to the store, which the scrapes own
+            store = open_score_store(storage, data_dirs[username], read_only=True)
+        except FileNotFoundError:
+            return 404, b"", ""
+        try:
+            # Along with where it is stored, which a reload may change while
+            # a request is still being served
+            version = f"{storage}:{data_dirs[username]}:{store.get_version()}"
+            key = (
+                (username, resource, since, limit)
+                if resource == "changes"
+                else (username, resource, 0, 0)
+            )
+            with self.lock:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.cache.move_to_end(key)
+            if cached is not None and cached[0] == version:
+                return 200, cached[1], cached[2]
+            if resource == "scores":
+                data = {
+                    "account": username,
+                    "courses": [dataclasses.asdict(x) for x in store.load_snapshot()],
+                }
+            else:
+                changes = store.load_changes(since, limit)
+                data = {
+                    "account": username,
+                    "changes": [
+                        {
+                            "seq": x.seq,
+                            "time": x.time,
+                            "type": x.type.name,
+                            "content": dataclasses.asdict(x.content),
+                            "prev": (
+                                dataclasses.asdict(x.prev)
+                                if x.prev is not None
+                                else None
+                            ),
+                        }
+                        for x in changes
+                    ],
+                    "next_since": changes[-1].seq if len(changes) != 0 else since,
+                }
+        finally:
+            store.close()
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        etag = _etag(body)
+        with self.lock:
+            self.cache[key] = (version, body, etag)
+            self.cache.move_to_end(key)
+            while len(self.cache) > RESPONSE_CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return 200, body, etag
+
+
+class _QueryHandler(BaseHTTPRequestHandler):
+    server: "_QueryServer"
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            status, body, etag = self.server.api.handle(url.path, url.query)
+        except Exception as e:  # pylint: disable=broad-except
+            _type = e.__class__.__name__
+            logger.error("Failed to serve %s: (%s) %s", url.path, _type, e)
+            self.send_error(500)
+            return
+        if status != 200:
+            self.send_error(status)
+            return
+        if _etag_matches(self.headers.get("If-None-Match", ""), etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class _QueryServer(ThreadingHTTPServer):
+    def __init__(self, address: tuple[str, int], api: QueryApi):
+        super().__init__(address, _QueryHandler)
+        self.api = api
+
+
+def start_query_api(config: QueryApiConfig, api: QueryApi) -> ThreadingHTTPServer:
+    server = _QueryServer((config.listen, config.port), api)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name="query-api", daemon=True
+    )
+    thread.start()
+    logger.info("Query API: http://%s:%d/accounts", config.listen, config.port)
+    return server
@@ -0,0 +1,115 @@
+import dataclasses
+import datetime
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class RandomizedConfig:
+    min: float
+    max: float
+
+    def random(self) -> float:
+        return random.uniform(self.min, self.max)
+
+
+@dataclasses.dataclass
+class BusyWindow:
+    # Inclusive "MM-DD" dates, repeated every year; wraps around the new year
+    # when `start` is after `end`
+    start: str
+    end: str
+
+    def __post_init__(self):
+        # Normalized so that the dates compare as strings
+        self.start = BusyWindow.__parse(self.start)
+        self.end = BusyWindow.__parse(self.end)
+
+    @staticmethod
+    def __parse(value: str) -> str:
+        try:
+            month, day = (int(x) for x in value.split("-"))
+            # A leap year, so that 02-29 is accepted
+            date = datetime.date(2000, month, day)
+        except (TypeError, ValueError, AttributeError) as e:
+            raise ValueError(f"Invalid busy window date (MM-DD): {value!r}") from e
+        return date.strftime("%m-%d")
+
+    def contains(self, date: datetime.date) -> bool:
+        today = date.strftime("%m-%d")
+        if self.start <= self.end:
+            return self.start <= today <= self.end
+        return today >= self.start or today <= self.end
+
+
+@dataclasses.dataclass
+class SchedulerConfig:
+    # Exam and grading periods, polled with `busy_interval`
+    busy_windows: list[BusyWindow] = dataclasses.field(default_factory=list)
+    busy_interval: RandomizedConfig = dataclasses.field(
+        default_factory=lambda: RandomizedConfig(60 * 15, 60 * 25)
+    )
+    # Seconds after a detected change during which `busy_interval` is used
+    after_change_period: float = 60 * 60 * 6
+    # Seconds without any change after which `stable_interval` is used
+    stable_after: float = 60 * 60 * 24 * 14
+    stable_interval: RandomizedConfig = dataclasses.field(
+        default_factory=lambda: RandomizedConfig(60 * 60 * 3, 60 * 60 * 5)
+    )
+    # Retry delay after a failure in seconds, doubled on each further failure
+    failure_backoff_base: float = 60 * 5
+    failure_backoff_max: float = 60 * 60 * 2
+    # Consecutive failures that open the circuit breaker, and for how long
+    circuit_breaker_threshold: int = 6
+    circuit_breaker_cooldown: float = 60 * 60 * 12
+
+
+class AdaptiveScheduler:
+    # `last_change_time` is the time of the last change in the change log, if
+    # any, otherwise stability is counted from `now`
+    def __init__(
+        self,
+        config: SchedulerConfig,
+        normal_interval: RandomizedConfig,
+        now: float,
+        last_change_time: float | None = None,
+    ):
+        self.config = config
+        self.normal_interval = normal_interval
+        self.last_change_time = (
+            last_change_time if last_change_time is not None else now
+        )
+        self.consecutive_failures = 0
+
+    # Records the outcome of a scrape (the number of changes, or `None` if it
+    # failed) and returns the delay before the next one with its reason
+    def next_interval(self, changes: int | None, now: float) -> tuple[float, str]:
+        config = self.config
+        if changes is None:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= max(config.circuit_breaker_threshold, 1):
+                return (
+                    config.circuit_breaker_cooldown,
+                    f"circuit open after {self.consecutive_failures} failures",
+                )
+            delay = min(
+                config.failure_backoff_base * 2 ** (self.consecutive_failures - 1),
+                config.failure_backoff_max,
+            )
+            return (
+                delay * random.uniform(0.8, 1.2),
+                f"backoff after {self.consecutive_failures} failure(s)",
+            )
+        self.consecutive_failures = 0
+        if changes > 0:
+            self.last_change_time = now
+        today = datetime.datetime.fromtimestamp(now).date()
+        if any(window.contains(today) for window in config.busy_windows):
+            return config.busy_interval.random(), "busy window"
+        if now - self.last_change_time < config.after_change_period:
+            return config.busy_interval.random(), "recent change"
+        if now - self.last_change_time >= config.stable_after:
+            return config.stable_interval.random(), "stable"
+        return self.normal_interval.random(), "normal"
@@ -0,0 +1,31 @@
+from typing import Iterable
+from njupt_score_pusher.njupt_eas import CourseScoreInfo, TermScope
+from njupt_score_pusher.pusher.entity import MessageEntity, MessageType
+
+
+# With a scope, `new_score` only covers the courses of that term, and courses of
+# other terms in `prev_score` are not reported as removed
+def diff_scores(
+    prev_score: Iterable[CourseScoreInfo],
+    new_score: Iterable[CourseScoreInfo],
+    scope: TermScope | None = None,
+) -> list[MessageEntity]:
+    prev_score_map = {x.id(): x for x in prev_score}
+    new_score_map = {x.id(): x for x in new_score}
+    changes = []
+    for course in new_score_map.values():
+        prev_course = prev_score_map.get(course.id())
+        if prev_course is None:
+            changes.append(MessageEntity(type=MessageType.NEW, content=course))
+        elif course != prev_course:
+            changes.append(
+                MessageEntity(
+                    type=MessageType.UPDATED, content=course, prev=prev_course
+                )
+            )
+    for prev_course in prev_score_map.values():
+        if scope is not None and not scope.contains(prev_course):
+            continue
+        if prev_course.id() not in new_score_map:
+            changes.append(MessageEntity(type=MessageType.REMOVED, content=prev_course))
+    return changes
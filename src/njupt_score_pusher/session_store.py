@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+from typing import Any
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore:
+    def __init__(self, path: str):
+        self.path = path
+
+    # Restores the saved cookies into `session`, returns whether the saved
+    # session goes through WebVPN, or `None` if there is no usable one
+    def load(self, session: requests.Session) -> bool | None:
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            for cookie in state["cookies"]:
+                session.cookies.set(
+                    cookie["name"],
+                    cookie["value"],
+                    domain=cookie["domain"],
+                    path=cookie["path"],
+                    secure=cookie["secure"],
+                    expires=cookie["expires"],
+                    rest=cookie["rest"],
+                )
+            return bool(state["use_web_vpn"])
+        except Exception as e:  # pylint: disable=broad-except
+            _type = e.__class__.__name__
+            logger.warning("Failed to load saved session: (%s) %s", _type, e)
+            session.cookies.clear()
+            return None
+
+    # Values remembered across runs along with the session, they are not tied
+    # to the cookies and survive a fresh login
+    def load_cache(self) -> dict[str, Any]:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cache = json.load(f).get("cache", {})
+            return cache if isinstance(cache, dict) else {}
+        except Exception as e:  # pylint: disable=broad-except
+            _type = e.__class__.__name__
+            logger.warning("Failed to load saved cache: (%s) %s", _type, e)
+            return {}
+
+    def save(
+        self,
+        session: requests.Session,
+        use_web_vpn: bool,
+        cache: dict[str, Any] | None = None,
+    ):
+        cookies = [
+            {
+                "name": cookie.name,
+                "value": cookie.value,
+                "domain": cookie.domain,
+                "path": cookie.path,
+                "secure": cookie.secure,
+                "expires": cookie.expires,
+                "rest": cookie._rest,  # pylint: disable=protected-access
+            }
+            for cookie in session.cookies
+        ]
+        state = {"use_web_vpn": use_web_vpn, "cookies": cookies, "cache": cache or {}}
+        # The cookies are as good as the password, keep them private
+        tmp_path = self.path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,317 @@
+import dataclasses
+import json
+import logging
+import os
+import sqlite3
+import time
+import urllib.parse
+from typing import Protocol
+from njupt_score_pusher.njupt_eas import CourseScoreInfo
+from njupt_score_pusher.pusher.entity import MessageEntity, MessageType
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class ScoreChange:
+    seq: int
+    time: float
+    type: MessageType
+    content: CourseScoreInfo
+    prev: CourseScoreInfo | None = None
+
+
+class ScoreStore(Protocol):
+    def load_snapshot(self) -> list[CourseScoreInfo]: ...
+
+    def load_changes(
+        self, since_seq: int = 0, limit: int = 100
+    ) -> list[ScoreChange]: ...
+
+    # Digest of the raw state of a scope, "" for the whole transcript
+    def get_digest(self, scope: str = "") -> str | None: ...
+
+    # Time of the last fetch of the whole transcript
+    def get_full_fetch_time(self) -> float | None: ...
+
+    # Changes whenever the snapshot or the change log changes
+    def get_version(self) -> str: ...
+
+    # Time of the last recorded change
+    def get_last_change_time(self) -> float | None: ...
+
+    # Applies the changes and records the digest of the new state of the scope
+    # atomically, the digests of other scopes are dropped if anything changed
+    def apply_changes(
+        self, changes: list[MessageEntity], digest: str, scope: str = ""
+    ) -> None: ...
+
+    def close(self) -> None: ...
+
+
+def _write_atomically(path: str, content: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _apply_to_snapshot(
+    snapshot: list[CourseScoreInfo], changes: list[MessageEntity]
+) -> list[CourseScoreInfo]:
+    courses = {x.id(): x for x in snapshot}
+    for change in changes:
+        if change.type == MessageType.REMOVED:
+            courses.pop(change.content.id(), None)
+        else:
+            courses[change.content.id()] = change.content
+    return list(courses.values())
+
+
+class JsonScoreStore:
+    def __init__(self, data_dir: str):
+        self.score_path = os.path.join(data_dir, "score.json")
+        self.digest_path = os.path.join(data_dir, "score.digest")
+
+    def load_snapshot(self) -> list[CourseScoreInfo]:
+        if not os.path.exists(self.score_path):
+            return []
+        with open(self.score_path, "r", encoding="utf-8") as f:
+            return [CourseScoreInfo(**x) for x in json.load(f)]
+
+    def load_changes(self, since_seq: int = 0, limit: int = 100) -> list[ScoreChange]:
+        # No history is kept in the JSON store
+        return []
+
+    def get_digest(self, scope: str = "") -> str | None:
+        return self.__load_meta()["digests"].get(scope)
+
+    def get_full_fetch_time(self) -> float | None:
+        return self.__load_meta().get("full_fetch_time")
+
+    def get_version(self) -> str:
+        try:
+            stat = os.stat(self.score_path)
+        except FileNotFoundError:
+            return "empty"
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def get_last_change_time(self) -> float | None:
+        # The snapshot is only rewritten when something changed
+        try:
+            return os.stat(self.score_path).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def apply_changes(
+        self, changes: list[MessageEntity], digest: str, scope: str = ""
+    ) -> None:
+        meta = self.__load_meta()
+        if len(changes) != 0 or not os.path.exists(self.score_path):
+            snapshot = _apply_to_snapshot(self.load_snapshot(), changes)
+            _write_atomically(
+                self.score_path,
+                json.dumps(list(map(dataclasses.asdict, snapshot)), ensure_ascii=False),
+            )
+            meta["digests"] = {}
+        meta["digests"][scope] = digest
+        if scope == "":
+            meta["full_fetch_time"] = time.time()
+        _write_atomically(self.digest_path, json.dumps(meta))
+
+    def __load_meta(self) -> dict:
+        if not os.path.exists(self.score_path) or not os.path.exists(self.digest_path):
+            return {"digests": {}}
+        with open(self.digest_path, "r", encoding="utf-8") as f:
+            content = f.read().strip()
+        # Older versions stored the digest of the whole transcript only
+        if not content.startswith("{"):
+            return {"digests": {"": content}}
+        return json.loads(content)
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteScoreStore:
+    # A read-only store never creates, migrates or imports anything, and
+    # raises FileNotFoundError if the database does not exist yet
+    def __init__(self, data_dir: str, read_only: bool = False):
+        path = os.path.join(data_dir, "score.db")
+        if read_only:
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+            self.conn = sqlite3.connect(
+                f"file:{urllib.parse.quote(path)}?mode=ro", uri=True
+            )
+            return
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS course ("
+                "id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS change_log ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "time REAL NOT NULL, "
+                "type TEXT NOT NULL, "
+                "course_id TEXT NOT NULL, "
+                "content TEXT NOT NULL, "
+                "prev TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+        if self.__get_meta("initialized") is None:
+            self.__import_json(JsonScoreStore(data_dir))
+
+    def load_snapshot(self) -> list[CourseScoreInfo]:
+        rows = self.conn.execute("SELECT data FROM course ORDER BY rowid")
+        return [CourseScoreInfo(**json.loads(data)) for (data,) in rows]
+
+    def load_changes(self, since_seq: int = 0, limit: int = 100) -> list[ScoreChange]:
+        rows = self.conn.execute(
+            "SELECT seq, time, type, content, prev FROM change_log "
+            "WHERE seq > ? ORDER BY seq LIMIT ?",
+            (since_seq, limit),
+        )
+        return [
+            ScoreChange(
+                seq=seq,
+                time=change_time,
+                type=MessageType[change_type],
+                content=CourseScoreInfo(**json.loads(content)),
+                prev=CourseScoreInfo(**json.loads(prev)) if prev is not None else None,
+            )
+            for seq, change_time, change_type, content, prev in rows
+        ]
+
+    def get_digest(self, scope: str = "") -> str | None:
+        return self.__get_meta(SqliteScoreStore.__digest_key(scope))
+
+    def get_full_fetch_time(self) -> float | None:
+        value = self.__get_meta("full_fetch_time")
+        return float(value) if value is not None else None
+
+    def get_version(self) -> str:
+        # Every change of the snapshot is logged
+        (seq,) = self.conn.execute("SELECT MAX(seq) FROM change_log").fetchone()
+        return str(seq or 0)
+
+    def get_last_change_time(self) -> float | None:
+        (change_time,) = self.conn.execute(
+            "SELECT MAX(time) FROM change_log"
+        ).fetchone()
+        return change_time
+
+    def apply_changes(
+        self, changes: list[MessageEntity], digest: str, scope: str = ""
+    ) -> None:
+        now = time.time()
+        with self.conn:
+            if len(changes) != 0:
+                self.conn.execute(
+                    "DELETE FROM meta WHERE key = 'digest' OR key LIKE 'digest:%'"
+                )
+            for change in changes:
+                course_id = change.content.id()
+                content = json.dumps(
+                    dataclasses.asdict(change.content), ensure_ascii=False
+                )
+                if change.type == MessageType.REMOVED:
+                    self.conn.execute("DELETE FROM course WHERE id = ?", (course_id,))
+                else:
+                    self.conn.execute(
+                        "INSERT INTO course (id, data) VALUES (?, ?) "
+                        "ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                        (course_id, content),
+                    )
+                self.conn.execute(
+                    "INSERT INTO change_log (time, type, course_id, content, prev) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (
+                        now,
+                        change.type.name,
+                        course_id,
+                        content,
+                        (
+                            json.dumps(
+                                dataclasses.asdict(change.prev), ensure_ascii=False
+                            )
+                            if change.prev is not None
+                            else None
+                        ),
+                    ),
+                )
+            self.__set_meta(SqliteScoreStore.__digest_key(scope), digest)
+            if scope == "":
+                self.__set_meta("full_fetch_time", str(now))
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __import_json(self, json_store: JsonScoreStore):
+        try:
+            snapshot = json_store.load_snapshot()
+        except (ValueError, TypeError) as e:
+            # E.g. truncated by a crash mid-write, kept aside for inspection
+            # and not read again, so the store starts empty
+            _type = e.__class__.__name__
+            corrupt_path = json_store.score_path + ".corrupt"
+            logger.error(
+                "Failed to import score.json, moved to %s: (%s) %s",
+                corrupt_path,
+                _type,
+                e,
+            )
+            os.replace(json_store.score_path, corrupt_path)
+            snapshot = []
+        try:
+            digest = json_store.get_digest()
+        except (ValueError, TypeError, AttributeError):
+            # Only saves a parse on the first fetch
+            digest = None
+        with self.conn:
+            for course in snapshot:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO course (id, data) VALUES (?, ?)",
+                    (
+                        course.id(),
+                        json.dumps(dataclasses.asdict(course), ensure_ascii=False),
+                    ),
+                )
+            if digest is not None:
+                self.__set_meta("digest", digest)
+            self.__set_meta("initialized", str(time.time()))
+        if len(snapshot) != 0:
+            logger.info("Imported %d courses from score.json", len(snapshot))
+
+    @staticmethod
+    def __digest_key(scope: str) -> str:
+        return "digest" if scope == "" else f"digest:{scope}"
+
+    def __get_meta(self, key: str) -> str | None:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def __set_meta(self, key: str, value: str):
+        self.conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+
+def open_score_store(kind: str, data_dir: str, read_only: bool = False) -> ScoreStore:
+    if kind == "json":
+        # Only written by `apply_changes`
+        return JsonScoreStore(data_dir)
+    if kind != "sqlite":
+        logger.error("Invalid storage: %s, fallback to sqlite", kind)
+    return SqliteScoreStore(data_dir, read_only)
@@ -0,0 +1,188 @@
+import contextlib
+import dataclasses
+import logging
+import random
+import threading
+import time
+from typing import Iterator
+import requests
+from njupt_score_pusher.phases import active_phases, record_transfer
+
+logger = logging.getLogger(__name__)
+
+# Methods that are safe to send again after a failure
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+@dataclasses.dataclass
+class TimeoutConfig:
+    # Seconds to establish a connection and to wait for each read
+    connect: float = 10
+    read: float = 30
+    # Seconds a scrape cycle may take in total, <= 0 for no limit
+    cycle: float = 300
+    # Share of `cycle` a single phase may take, by phase name
+    phase_budgets: dict[str, float] = dataclasses.field(
+        default_factory=lambda: {
+            "webvpn_detect": 0.1,
+            "session_check": 0.1,
+            "sso_login": 0.5,
+            "grant_service": 0.2,
+            "get_score": 0.6,
+        }
+    )
+    # Retries of idempotent requests after a network error or a 5xx response
+    retries: int = 2
+    # Delay before the first retry in seconds, doubled on each further retry
+    retry_base_delay: float = 1
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, budget: str, phase_name: str):
+        super().__init__(f"Budget of {budget} exceeded in phase {phase_name}")
+        self.budget = budget
+        self.phase_name = phase_name
+
+
+__local = threading.local()
+
+
+# Limits the requests sent in the current thread to the cycle deadline
+@contextlib.contextmanager
+def cycle_deadline(config: TimeoutConfig) -> Iterator[None]:
+    __local.deadline = (config, time.perf_counter())
+    try:
+        yield
+    finally:
+        __local.deadline = None
+
+
+# The deadline of the current thread, to carry into a helper thread with
+# `inherited_deadline`
+def current_deadline() -> tuple[TimeoutConfig, float] | None:
+    return getattr(__local, "deadline", None)
+
+
+# Applies a deadline taken from another thread to the current one
+@contextlib.contextmanager
+def inherited_deadline(deadline: tuple[TimeoutConfig, float] | None) -> Iterator[None]:
+    __local.deadline = deadline
+    try:
+        yield
+    finally:
+        __local.deadline = None
+
+
+# Returns the remaining seconds of the tightest budget of the current thread
+# and its name, or `None` if no deadline is set
+def remaining_budget() -> tuple[float, str] | None:
+    state = getattr(__local, "deadline", None)
+    if state is None:
+        return None
+    config, start = state
+    now = time.perf_counter()
+    result: tuple[float, str] | None = None
+    if config.cycle > 0:
+        result = (start + config.cycle - now, "cycle")
+        for name, phase_start in active_phases():
+            share = config.phase_budgets.get(name)
+            if share is None or share <= 0:
+                continue
+            remaining = phase_start + share * config.cycle - now
+            if remaining < result[0]:
+                result = (remaining, name)
+    return result
+
+
+def check_deadline():
+    budget = remaining_budget()
+    if budget is not None and budget[0] <= 0:
+        phases = active_phases()
+        raise DeadlineExceeded(budget[1], phases[-1][0] if phases else "none")
+
+
+class TimeoutSession(requests.Session):
+    # Applies the timeouts and the cycle deadline to every request, and
+    # retries idempotent ones with jittered exponential backoff
+    def __init__(self, config: TimeoutConfig, retries: int | None = None):
+        super().__init__()
+        self.timeout_config = config
+        self.retries = retries if retries is not None else config.retries
+
+    def request(self, method, url, *args, **kwargs):
+        requested_timeout = kwargs.pop("timeout", None)
+        attempts = 1
+        if method.upper() in IDEMPOTENT_METHODS:
+            attempts += max(self.retries, 0)
+        for attempt in range(1, attempts + 1):
+            check_deadline()
+            kwargs["timeout"] = self.__timeout(requested_timeout)
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                record_transfer(requests=1)
+                # Running out of budget is not a network failure
+                check_deadline()
+                if attempt == attempts:
+                    raise
+                _type = e.__class__.__name__
+                logger.debug("Retrying %s %s after (%s) %s", method, url, _type, e)
+            else:
+                self.__record(response, kwargs.get("stream", False))
+                if response.status_code < 500 or attempt == attempts:
+                    return response
+                logger.debug(
+                    "Retrying %s %s after status %d", method, url, response.status_code
+                )
+                response.close()
+            self.__sleep_before_retry(attempt)
+        raise AssertionError("unreachable")
+
+    @staticmethod
+    def __record(response: requests.Response, stream: bool):
+        # Redirects followed on the way count as requests of their own
+        exchanges = response.history + [response]
+        sent = 0
+        for exchange in exchanges:
+            request = exchange.request
+            # Roughly the request line and headers, plus the body
+            sent += len(request.method or "") + len(request.url or "")
+            sent += sum(len(k) + len(v) + 4 for k, v in request.headers.items())
+            if isinstance(request.body, (bytes, str)):
+                sent += len(request.body)
+        received = sum(len(x.content) for x in response.history)
+        if not stream:
+            received += len(response.content)
+        else:
+            # Counted while the caller reads it, in the phase reading it
+            iter_content = response.iter_content
+
+            def counted_iter_content(*args, **kwargs):
+                for chunk in iter_content(*args, **kwargs):
+                    record_transfer(received=len(chunk))
+                    yield chunk
+
+            response.iter_content = counted_iter_content  # type: ignore
+        record_transfer(requests=len(exchanges), sent=sent, received=received)
+
+    def __timeout(self, requested) -> tuple[float, float]:
+        config = self.timeout_config
+        if isinstance(requested, tuple):
+            connect, read = requested
+        elif requested is not None:
+            connect, read = requested, requested
+        else:
+            connect, read = config.connect, config.read
+        budget = remaining_budget()
+        if budget is not None:
+            connect = min(connect, budget[0])
+            read = min(read, budget[0])
+        return connect, read
+
+    def __sleep_before_retry(self, attempt: int):
+        delay = self.timeout_config.retry_base_delay * 2 ** (attempt - 1)
+        delay *= random.uniform(0.5, 1.5)
+        budget = remaining_budget()
+        if budget is not None:
+            delay = min(delay, max(budget[0], 0))
+        time.sleep(delay)
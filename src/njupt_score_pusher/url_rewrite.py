@@ -0,0 +1,26 @@
+import requests
+import requests.adapters
+
+
+class UrlRewriteAdapter(requests.adapters.HTTPAdapter):
+    # Sends requests for `prefix` to `target` instead, while the session keeps
+    # seeing the original URLs, so cookies and redirects work unchanged
+    def __init__(self, prefix: str, target: str):
+        super().__init__()
+        self.prefix = prefix
+        self.target = target
+
+    def send(self, request, *args, **kwargs):  # pylint: disable=arguments-differ
+        original_url = request.url
+        request.url = self.target + original_url[len(self.prefix) :]
+        try:
+            response = super().send(request, *args, **kwargs)
+        finally:
+            request.url = original_url
+        response.url = original_url
+        return response
+
+
+def mount_url_overrides(session: requests.Session, overrides: dict[str, str]):
+    for prefix, target in overrides.items():
+        session.mount(prefix, UrlRewriteAdapter(prefix, target.rstrip("/")))